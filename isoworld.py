@@ -7,7 +7,7 @@
 # course: L2, 2i013 Projet, "Vie Artificielle"
 # licence: CC-BY-SA
 #
-# Requirements: Python3, Pygame
+# Requirements: Python3, Pygame, NumPy
 #
 # Credits for third party resources used in this project:
 # - Assets: https://www.kenney.nl/ (great assets by Kenney Vleugels with *public domain license*)
@@ -33,10 +33,28 @@
 
 
 import sys
+import os
 import datetime
+import tempfile
+import struct
 from random import *
 import math
 import time
+import collections
+import copy
+import heapq
+import weakref
+import signal
+import multiprocessing
+from multiprocessing import shared_memory
+import xml.etree.ElementTree
+
+import numpy as np
+
+try:
+    import numba # optional: compiled kernels (cf. useKernels)
+except ImportError:
+    numba = None
 
 import pygame
 from pygame.locals import *
@@ -58,6 +76,42 @@ nbTrees = 35 #350
 nbBurningTrees = 1 #15
 nbAgents = 10
 
+# simulation runs on a fixed timestep, independently from rendering. At each tick, the scheduler of the world (cf. Scheduler) runs the tasks due: world (ie. fire) and agents updates, ghosts spawning.
+# Tasks run every <period> ticks, at ticks where tick % period == phase. Different phases spread work across frames (tasks do not all run at the same tick).
+ticksPerSecond = 30 # number of simulation ticks per second, at normal speed
+worldStepPeriod = ticksPerSecond // 10 # cf. stepWorld()
+worldStepPhase = 0
+agentsStepPeriod = ticksPerSecond // 10 # cf. stepAgents()
+agentsStepPhase = 1
+spawnPeriod = 10 # a new ghost appears every spawnPeriod ticks (cf. spawnGhost())
+spawnPhase = 2
+speedSteps = [ 1, 2, 10, 100 ] # possible simulation speeds (fast-forward factors, using hotkeys)
+simulationSpeed = 1 # current simulation speed (0: pause)
+
+fireEngine = "frontier" # fire propagation (cf. World.stepWorld()): "scan" visits all trees ; "frontier" only visits trees next to cells that changed or to ghosts (same result, in time proportional to the fire front rather than to the forest)
+                        # "stencil": all rules of stencilRules are applied at once to whole maps, with NumPy (synchronous update: trees set on fire do not spread fire before the next step, so results differ from "scan")
+useKernels = True # step the "scan" fire engine and agent moves with kernels compiled by Numba, if installed (same results, much faster). Cf. checkKernels() and command line option "--check-kernels".
+nbWorkers = 0 # "stencil" fire engine: number of worker processes, each one stepping a strip of the world (0: no worker, the whole world is stepped by the main process). Requires worldStorage = "shared" and the "fork" start method (Linux, macOS).
+
+# headless mode: simulation only, as fast as possible (no window, no sprites, no event loop). Also set with command line option "--headless".
+headless = False
+nbIterations = 1000000 # headless mode: number of iterations before exit
+snapshotPeriod = 0 # headless mode: save an image of the world every snapshotPeriod iterations (0: never)
+
+# saving/loading worlds (cf. saveWorld() and loadWorld()). With command line option "--load", the world is loaded from worldFilename instead of being created by initWorld().
+worldFilename = "world.npz"
+savePeriod = 0 # headless mode: save the world to worldFilename every savePeriod iterations (0: never), e.g. to resume a long run after a crash
+compressWorldFiles = True # compress saved worlds (zlib)
+
+# journal (cf. Journal): if journalFilename is set, every cell change of the world is appended to this file (13 bytes per change), and the world is saved next to it every journalSnapshotPeriod ticks.
+# replayWorld() rebuilds the world at any tick from these files, much faster than running the simulation again.
+journalFilename = None
+journalSnapshotPeriod = 10000
+journalBufferSize = 1024 * 1024 # in bytes
+
+if "--headless" in sys.argv:
+    headless = True
+
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
@@ -74,13 +128,22 @@ screenHeight = 640 #900
 worldWidth = 32#64
 worldHeight = 32#64
 
+# world storage: "dense" (world maps are allocated at once) or "chunked" (world maps are split into chunks of storageChunkSize x storageChunkSize cells, only allocated when written -- for very large worlds where only a few regions are used)
+# or "memmap" (world maps are temporary files in worldDirectory, mapped in memory: only the parts actually used are loaded -- for worlds larger than memory. Saved worlds keep copies of these files, cf. saveWorld())
+# or "shared" (same as "dense", in shared memory: worker processes can step the world without copying it -- cf. nbWorkers)
+worldStorage = "dense"
+storageChunkSize = 64
+worldDirectory = "worlds"
+
 # set surface of displayed tiles (ie. nb of cells that are rendered) -- must be superior to worldWidth and worldHeight
 viewWidth = 32 #32
 viewHeight = 32 #32
 
 scaleMultiplier = 0.25 # re-scaling of loaded images
+zoomSteps = [ 0.125, 0.25, 0.5, 1.0 ] # possible values for scaleMultiplier (using hotkeys). Images are pre-scaled for all steps at startup.
+spriteCacheBudget = 64 * 1024 * 1024 # max. memory (in bytes) used by re-scaled images. Least recently used images are dropped first (and re-scaled again when needed).
 
-objectMapLevels = 8 # number of levels for the objectMap. This determines how many objects you can pile upon one another.
+objectMapLevels = 8 # number of levels for objects. This determines how many objects you can pile upon one another. Unused levels cost nothing (cf. objectStacks).
 
 # set scope of displayed tiles
 xViewOffset = 0
@@ -88,7 +151,13 @@ yViewOffset = 0
 
 addNoise = False
 
+renderMode = "dirty" # "full": redraw all cells at each frame ; "dirty": only redraw cells that changed since last frame (full redraw if view changes) ; "layered": pre-rendered static terrain + dynamic objects and agents drawn on top ; "chunked": pre-rendered chunks of cells + agents drawn on top (for large worlds)
+staticLayerCacheSize = 8 # "layered" mode: max. number of pre-rendered static layers kept in memory (one per view offset)
+chunkSize = 16 # "chunked" mode: chunks are squares of chunkSize x chunkSize cells (chunks on the last row/column are smaller if world size is not a multiple of chunkSize)
+chunkCacheBudget = 128 * 1024 * 1024 # "chunked" mode: max. memory (in bytes) used by pre-rendered chunks. Least recently used chunks are dropped first (and re-rendered when needed).
+
 maxFps = 30 # set up maximum number of frames-per-second
+minFps = 5 # if rendering and simulation cannot keep up with simulationSpeed, frames are dropped (ie. several ticks per frame) but not below this number of frames-per-second (simulation is slowed down instead)
 
 verbose = False # display message in console on/off
 verboseFps = True # display FPS every once in a while
@@ -101,6 +170,9 @@ verboseFps = True # display FPS every once in a while
 ###
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 
+if headless == True:
+    os.environ["SDL_VIDEODRIVER"] = "dummy" # no window. Rendering is still possible (off-screen), for snapshots.
+
 pygame.init()
 #pygame.key.set_repeat(5,5)
 fpsClock = pygame.time.Clock()
@@ -115,12 +187,68 @@ pygame.display.set_caption('World of Isotiles')
 ###
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 
-def loadImage(filename):
-    global tileTotalWidthOriginal,tileTotalHeightOriginal,scaleMultiplier
-    image = pygame.image.load(filename).convert_alpha()
-    image = pygame.transform.scale(image, (int(tileTotalWidthOriginal*scaleMultiplier), int(tileTotalHeightOriginal*scaleMultiplier)))
+originalImages = {} # filename => image, as loaded from disk (never re-loaded)
+scaledImages = collections.OrderedDict() # (filename,scale) => re-scaled image, from least to most recently used
+scaledImagesMemory = 0 # memory used by scaledImages (in bytes)
+
+def getOriginalImage(filename):
+    if not filename in originalImages:
+        originalImages[filename] = pygame.image.load(filename).convert_alpha()
+    return originalImages[filename]
+
+def getScaledImage(filename,scale):
+    # returns image re-scaled to tile size
+    global scaledImagesMemory
+    key = (filename,scale)
+    if key in scaledImages:
+        scaledImages.move_to_end(key)
+        return scaledImages[key]
+    image = pygame.transform.scale(getOriginalImage(filename), (int(tileTotalWidthOriginal*scale), int(tileTotalHeightOriginal*scale)))
+    scaledImages[key] = image
+    scaledImagesMemory = scaledImagesMemory + image.get_pitch() * image.get_height()
+    while scaledImagesMemory > spriteCacheBudget and len(scaledImages) > 1:
+        oldImage = scaledImages.popitem(last=False)[1]
+        scaledImagesMemory = scaledImagesMemory - oldImage.get_pitch() * oldImage.get_height()
     return image
 
+def prescaleAllImages(): # re-scale all images for all zoom steps, so that changing scale never requires to load or re-scale images
+    for scale in zoomSteps + [ scaleMultiplier ]: # current scale last, ie. most recently used
+        for filename in list(originalImages):
+            getScaledImage(filename,scale)
+    return
+
+def loadImage(filename):
+    return getScaledImage(filename,scaleMultiplier)
+
+###
+
+atlases = {} # spritesheet description filename (.xml) => { sprite name: (x,y,width,height) }
+atlasSheets = {} # spritesheet image filename (.png) => spritesheet, as loaded from disk (never re-loaded)
+
+def loadAtlas(filename):
+    # read spritesheet description (Kenney/ShoeBox TextureAtlas .xml). Spritesheet image is the .png file with the same name.
+    if not filename in atlases:
+        atlas = {}
+        for subTexture in xml.etree.ElementTree.parse(filename).getroot().iter('SubTexture'):
+            atlas[subTexture.get('name')] = ( int(subTexture.get('x')), int(subTexture.get('y')), int(subTexture.get('width')), int(subTexture.get('height')) )
+        atlases[filename] = atlas
+    return atlases[filename]
+
+def loadAtlasImage(filename,name):
+    # returns sprite <name> (e.g. 'abstractTile_12' or 'abstractTile_12.png') from spritesheet <filename> (.xml), re-scaled.
+    # The spritesheet is loaded only once. Sprites are sub-surfaces of the original spritesheet, re-scaled one by one as any other image (same pixels as the sprite's own .png file, at all scales).
+    atlas = loadAtlas(filename)
+    if not name in atlas:
+        name = name + '.png'
+    sheetFilename = filename[:-len('.xml')]+'.png'
+    spriteFilename = sheetFilename+':'+name # key for image caches
+    if not spriteFilename in originalImages:
+        if not sheetFilename in atlasSheets:
+            atlasSheets[sheetFilename] = pygame.image.load(sheetFilename).convert_alpha()
+        sheet = atlasSheets[sheetFilename]
+        originalImages[spriteFilename] = sheet.subsurface( pygame.Rect(atlas[name]).clip( sheet.get_rect() ) )
+    return getScaledImage(spriteFilename,scaleMultiplier)
+
 def loadAllImages():
     global tileType, objectType, agentType
 
@@ -129,14 +257,15 @@ def loadAllImages():
     agentType = []
 
     tileType.append(loadImage('assets/basic111x128/platformerTile_48_ret.png')) # grass
-    tileType.append(loadImage('assets/ext/isometric-blocks/PNG/Platformer tiles/platformerTile_33.png')) # brick
-    tileType.append(loadImage('assets/ext/isometric-blocks/PNG/Abstract tiles/abstractTile_12.png')) # blue grass (?)
-    tileType.append(loadImage('assets/ext/isometric-blocks/PNG/Abstract tiles/abstractTile_09.png')) # grey brock
+    tileType.append(loadAtlasImage('assets/ext/isometric-blocks/Spritesheet/allTiles_sheet.xml','platformerTile_33')) # brick
+    tileType.append(loadAtlasImage('assets/ext/isometric-blocks/Spritesheet/allTiles_sheet.xml','abstractTile_12')) # blue grass (?)
+    tileType.append(loadAtlasImage('assets/ext/isometric-blocks/Spritesheet/allTiles_sheet.xml','abstractTile_09')) # grey brock
 
     objectType.append(None) # default -- never drawn
     objectType.append(loadImage('assets/basic111x128/tree_small_NW_ret.png')) # normal tree
     objectType.append(loadImage('assets/basic111x128/blockHuge_N_ret.png')) # construction block
     objectType.append(loadImage('assets/basic111x128/tree_small_NW_ret_red.png')) # burning tree
+    objectType.append(loadImage('assets/basic111x128/tree_small_NW_ret_ash.png')) # ash (burnt tree)
 
     agentType.append(None) # default -- never drawn
     agentType.append(loadImage('assets/basic111x128/invader_ret.png')) # invader
@@ -149,7 +278,8 @@ def resetImages():
     tileTotalHeight = tileTotalHeightOriginal * scaleMultiplier # height of tile image, as stored in memory
     tileVisibleHeight = tileVisibleHeightOriginal * scaleMultiplier # height "visible" part of the image, as stored in memory
     heightMultiplier = tileTotalHeight/2 # should be less than (or equal to) tileTotalHeight
-    loadAllImages()
+    if headless == False: # headless mode: sprites are loaded on first snapshot (cf. saveSnapshot())
+        loadAllImages()
     return
 
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
@@ -176,11 +306,18 @@ noObjectId = noAgentId = 0
 grassId = 0
 treeId = 1
 burningTreeId = 3
+ashId = 4
 invaderId = 1
 ghostId = 2
 babyId = 3
 blockId = 2
 
+dynamicObjectIds = [ treeId, burningTreeId, ashId ] # objects that may change during simulation. Other objects are considered as static (ie. pre-rendered in "layered" mode)
+
+# lifetime of objects on level 0 (cf. World.timers): object type => (number of ticks, next object type). Other objects last forever.
+# E.g. { burningTreeId: (20, ashId), ashId: (500, treeId) }: burning trees turn to ash, which grows back into trees (forest-fire dynamics).
+objectLifetimes = {}
+
 ###
 
 # re-scale reference image size -- must be done *after* loading sprites
@@ -188,16 +325,33 @@ resetImages()
 
 ###
 
-terrainMap = [x[:] for x in [[0] * worldWidth] * worldHeight]
-heightMap  = [x[:] for x in [[0] * worldWidth] * worldHeight]
-objectMap = [ [ [ 0 for i in range(worldWidth) ] for j in range(worldHeight) ] for k in range(objectMapLevels) ]
-agentMap   = [x[:] for x in [[0] * worldWidth] * worldHeight]
+# dirty-cell tracking (used if renderMode is "dirty")
+dirtyCells = {} # cells modified since last frame: (x,y) => (height,column top) of cell before modification
+renderState = None # view parameters used for last frame. Any change implies a full redraw.
+
+# projection tables (cf. updateProjectionTables())
+projectionKey = None # view size, scale and screen offset used to compute xScreenTable and yScreenTable
+xScreenTable = yScreenTable = [] # screen coordinates of cell (x,y) of the view are (xScreenTable[x-y+viewHeight-1], yScreenTable[x+y]-height)
+xTileTable = yTileTable = [] # world coordinates of column x and row y of the view
+
+repaintBuffer = None # off-screen surface used to redraw parts of the screen (cf. repaintRects())
+
+# static/dynamic layers (used if renderMode is "layered")
+staticLayers = {} # pre-rendered terrain and static objects: view parameters => surface. Cleared whenever a static element changes.
+dynamicCells = set() # cells with an agent or a dynamic object: (x,y)
+
+# pre-rendered chunks (used if renderMode is "chunked")
+chunkSurfaces = collections.OrderedDict() # (chunk x, chunk y, first/last column and row, position fraction, scale) => (surface, offset), from least to most recently used
+chunkSurfacesMemory = 0 # memory used by chunkSurfaces (in bytes)
+chunkKeys = {} # (chunk x, chunk y) => keys of chunkSurfaces for this chunk
+agentCells = set() # cells with an agent: (x,y)
 
 ###
 
 # set initial position for display on screen
 xScreenOffset = screenWidth/2 - tileTotalWidth/2
 yScreenOffset = 3*tileTotalHeight # border. Could be 0.
+xScreenOffsetReference = xScreenOffset # xScreenOffset may drift by less than a pixel when scrolling (cf. scrollView())
 
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
@@ -224,6 +378,8 @@ def displayWelcomeMessage():
     print ("Verbose all       :",verbose)
     print ("Verbose fps       :",verboseFps)
     print ("Maximum fps       :",maxFps)
+    print ("Ticks per second  :",ticksPerSecond)
+    print ("Headless          :",headless)
     print ("")
 
     print ("# Hotkeys:")
@@ -234,16 +390,18 @@ def displayWelcomeMessage():
     print ("\tO           : increase view surface")
     print ("\ts           : decrease scaling")
     print ("\tS           : increase scaling")
+    print ("\t1,2,3,4     : simulation speed x"+",x".join(str(speed) for speed in speedSteps))
+    print ("\tp           : pause/resume simulation")
     print ("\tESC         : quit")
     print ("")
 
     return
 
 def getWorldWidth():
-    return worldWidth
+    return defaultWorld.getWidth()
 
 def getWorldHeight():
-    return worldHeight
+    return defaultWorld.getHeight()
 
 def getViewWidth():
     return viewWidth
@@ -251,37 +409,81 @@ def getViewWidth():
 def getViewHeight():
     return viewHeight
 
+# get/set methods of the default world (cf. World)
+
 def getTerrainAt(x,y):
-    return terrainMap[y][x]
+    return defaultWorld.getTerrainAt(x,y)
 
 def setTerrainAt(x,y,type):
-    terrainMap[y][x] = type
+    defaultWorld.setTerrainAt(x,y,type)
 
 def getHeightAt(x,y):
-    return heightMap[y][x]
+    return defaultWorld.getHeightAt(x,y)
 
 def setHeightAt(x,y,height):
-    heightMap[y][x] = height
+    defaultWorld.setHeightAt(x,y,height)
 
 def getObjectAt(x,y,level=0):
-    if level < objectMapLevels:
-        return objectMap[level][y][x]
-    else:
-        print ("[ERROR] getObjectMap(.) -- Cannot return object. Level does not exist.")
-        return 0
+    return defaultWorld.getObjectAt(x,y,level)
 
 def setObjectAt(x,y,type,level=0): # negative values are possible: invisible but tangible objects (ie. no display, collision)
-    if level < objectMapLevels:
-        objectMap[level][y][x] = type
-    else:
-        print ("[ERROR] setObjectMap(.) -- Cannot set object. Level does not exist.")
-        return 0
+    return defaultWorld.setObjectAt(x,y,type,level)
+
+def getColumnHeight(x,y): # number of object levels used at (x,y), ie. highest non-empty level + 1 (0: no object). Levels above are empty.
+    return defaultWorld.getColumnHeight(x,y)
+
+def getCellsWith(type,level=0): # cells (x,y) with an object of this type on this level (cf. World.getCellsWith())
+    return defaultWorld.getCellsWith(type,level)
+
+def countObjects(type,level=None): # number of objects of this type on this level (default: all levels)
+    return defaultWorld.countObjects(type,level)
 
 def getAgentAt(x,y):
-    return agentMap[y][x]
+    return defaultWorld.getAgentAt(x,y)
 
 def setAgentAt(x,y,type):
-    agentMap[y][x] = type
+    defaultWorld.setAgentAt(x,y,type)
+
+### ### ### ### ###
+
+def cellWillChange(x,y,layer,previousValue,newValue): # called by the default world before cell (x,y) is modified (cf. World.onCellChange): keep track of what must be redrawn
+    markDirty(x,y)
+    if layer == "agent": # agents are never pre-rendered
+        return
+    dropChunk(x,y)
+    if layer != "object" or ( previousValue > 0 and not previousValue in dynamicObjectIds ) or ( newValue > 0 and not newValue in dynamicObjectIds ):
+        staticLayers.clear()
+
+def markDirty(x,y): # record that cell (x,y) must be redrawn. Remember its height and column top *before* change, so that its former display area can be cleared.
+    if (x,y) not in dirtyCells:
+        dirtyCells[(x,y)] = ( getHeightAt(x,y), getColumnTop(x,y) )
+
+def getColumnTop(x,y): # number of levels displayed above terrain at (x,y): highest visible object level + 1 (an agent is displayed as a level 0 object)
+    for level in range(getColumnHeight(x,y)-1,-1,-1):
+        if getObjectAt(x,y,level) > 0:
+            return level + 1
+    if getAgentAt(x,y) != 0:
+        return 1
+    return 0
+
+def updateDynamicCell(x,y): # record whether cell (x,y) contains an agent (drawn on top of pre-rendered chunks in "chunked" mode) or a dynamic object (both drawn on top of the static layer in "layered" mode)
+    if getAgentAt(x,y) != 0:
+        agentCells.add((x,y))
+        dynamicCells.add((x,y))
+        return
+    agentCells.discard((x,y))
+    for level in range(getColumnHeight(x,y)):
+        if getObjectAt(x,y,level) in dynamicObjectIds:
+            dynamicCells.add((x,y))
+            return
+    dynamicCells.discard((x,y))
+
+def dropChunk(x,y): # forget pre-rendered images of the chunk containing cell (x,y) (agents are not pre-rendered)
+    global chunkSurfacesMemory
+    for key in chunkKeys.pop( ( x // chunkSize, y // chunkSize ), () ):
+        if key in chunkSurfaces:
+            surface = chunkSurfaces.pop(key)[0]
+            chunkSurfacesMemory = chunkSurfacesMemory - surface.get_pitch() * surface.get_height()
 
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
@@ -290,46 +492,473 @@ def setAgentAt(x,y,type):
 ###
 ###
 
-def render( it = 0 ):
-    global xViewOffset, yViewOffset
+def updateProjectionTables():
+    # pre-compute screen coordinates of all cells of the view (without height), and world coordinates of all rows and columns of the view.
+    # Screen coordinates only depend on view size, scale and screen offset: they are re-computed only when one of these changes.
+    global xScreenTable, yScreenTable, projectionKey, xTileTable, yTileTable
+    key = ( getViewWidth(), getViewHeight(), scaleMultiplier, xScreenOffset, yScreenOffset )
+    if key != projectionKey:
+        projectionKey = key
+        xScreenTable = [ math.floor( xScreenOffset + d * tileTotalWidth / 2 ) for d in range( -getViewHeight()+1, getViewWidth() ) ] # indexed by x-y+viewHeight-1, rounded down, so that scrolling by an integer shift gives the same result
+        yScreenTable = [ yScreenOffset + d * tileVisibleHeight / 2 for d in range( getViewWidth() + getViewHeight() - 1 ) ] # indexed by x+y
+    xTileTable = [ ( xViewOffset + x + getWorldWidth() ) % getWorldWidth() for x in range(getViewWidth()) ]
+    yTileTable = [ ( yViewOffset + y + getWorldHeight() ) % getWorldHeight() for y in range(getViewHeight()) ]
+    return
 
-    pygame.draw.rect(screen, (0,0,0), (0, 0, screenWidth, screenHeight), 0) # overkill - can be optimized. (most sprites are already "naturally" overwritten)
-    #pygame.display.update()
+def renderCell( x, y, sprites, it = 0, layer = "all" ):
+    # add sprites of cell at position (x,y) in the view (ie. not in the world) to the list of sprites to draw, in drawing order.
+    # layer is "all" or "static" (terrain and static objects only)
+    # assume: north-is-upper-right
+
+    xTile = xTileTable[x]
+    yTile = yTileTable[y]
+
+    heightNoise = 0
+    if addNoise == True: # add sinusoidal noise on height positions
+        if it%int(math.pi*2*199) < int(math.pi*199):
+            # v1.
+            heightNoise = math.sin(it/23+yTile) * math.sin(it/7+xTile) * heightMultiplier/10 + math.cos(it/17+yTile+xTile) * math.cos(it/31+yTile) * heightMultiplier
+            heightNoise = math.sin(it/199) * heightNoise
+        else:
+            # v2.
+            heightNoise = math.sin(it/13+yTile*19) * math.cos(it/17+xTile*41) * heightMultiplier
+            heightNoise = math.sin(it/199) * heightNoise
+
+    height = getHeightAt( xTile , yTile ) * heightMultiplier + heightNoise
 
-    for y in range(getViewHeight()):
-        for x in range(getViewWidth()):
-            # assume: north-is-upper-right
+    xScreen = xScreenTable[x - y + getViewHeight() - 1]
+    yScreen = yScreenTable[x + y] - height
 
-            xTile = ( xViewOffset + x + getWorldWidth() ) % getWorldWidth()
-            yTile = ( yViewOffset + y + getWorldHeight() ) % getWorldHeight()
+    addCellSprites( xTile, yTile, xScreen, yScreen, sprites, layer )
 
-            heightNoise = 0
-            if addNoise == True: # add sinusoidal noise on height positions
-                if it%int(math.pi*2*199) < int(math.pi*199):
-                    # v1.
-                    heightNoise = math.sin(it/23+yTile) * math.sin(it/7+xTile) * heightMultiplier/10 + math.cos(it/17+yTile+xTile) * math.cos(it/31+yTile) * heightMultiplier
-                    heightNoise = math.sin(it/199) * heightNoise
+    return
+
+def addCellSprites( xTile, yTile, xScreen, yScreen, sprites, layer = "all" ):
+    # add sprites of cell (xTile,yTile) of the world to the list of sprites to draw, with terrain displayed at (xScreen,yScreen)
+    # layer is "all", "static" (terrain and static objects only) or "objects" (terrain and objects, no agent)
+
+    sprites.append( ( tileType[ getTerrainAt( xTile , yTile ) ] , (xScreen, yScreen) ) ) # display terrain
+
+    for level in range( getColumnHeight( xTile , yTile ) ):
+        objectId = getObjectAt( xTile , yTile , level )
+        if objectId > 0: # object on terrain?
+            if layer != "static" or not objectId in dynamicObjectIds:
+                sprites.append( ( objectType[ objectId ] , (xScreen, yScreen - heightMultiplier*(level+1)) ) )
+
+    if layer == "all":
+        agentId = getAgentAt( xTile, yTile )
+        if agentId != 0: # agent on terrain?
+            sprites.append( ( agentType[ agentId ] , (xScreen, yScreen - heightMultiplier) ) )
+
+    return
+
+def getCellRect( x, y, height, columnTop = None ):
+    # screen area that may be covered by cell (x,y) of the view (terrain, object levels and agent), if its height is <height> and <columnTop> levels are displayed above terrain (default: any number of levels)
+    if columnTop == None:
+        columnTop = defaultWorld.maxObjectLevel
+    xScreen = xScreenOffset + x * tileTotalWidth / 2 - y * tileTotalWidth / 2
+    yScreen = yScreenOffset + y * tileVisibleHeight / 2 + x * tileVisibleHeight / 2 - height * heightMultiplier
+    top = int( yScreen - heightMultiplier * columnTop ) - 1
+    bottom = int( yScreen + tileTotalHeight ) + 1
+    return pygame.Rect( math.floor(xScreen) - 1, top, int(tileTotalWidth) + 2, bottom - top )
+
+def getDynamicRect( x, y ):
+    # screen area covered by dynamic objects and agent of cell (x,y) of the view (None if there are none)
+    xTile = ( xViewOffset + x + getWorldWidth() ) % getWorldWidth()
+    yTile = ( yViewOffset + y + getWorldHeight() ) % getWorldHeight()
+    xScreen = xScreenOffset + x * tileTotalWidth / 2 - y * tileTotalWidth / 2
+    yScreen = yScreenOffset + y * tileVisibleHeight / 2 + x * tileVisibleHeight / 2 - getHeightAt( xTile , yTile ) * heightMultiplier
+    area = None
+    for level in range( getColumnHeight( xTile , yTile ) ):
+        if getObjectAt( xTile , yTile , level) in dynamicObjectIds:
+            rect = objectType[ getObjectAt( xTile , yTile, level) ].get_rect( topleft = ( math.floor(xScreen), int(yScreen - heightMultiplier*(level+1)) ) )
+            area = rect if area == None else area.union(rect)
+    rect = getAgentRect( x, y )
+    if rect != None:
+        area = rect if area == None else area.union(rect)
+    return area
+
+def getAgentRect( x, y ):
+    # screen area covered by the agent of cell (x,y) of the view (None if there is none)
+    xTile = ( xViewOffset + x + getWorldWidth() ) % getWorldWidth()
+    yTile = ( yViewOffset + y + getWorldHeight() ) % getWorldHeight()
+    if getAgentAt( xTile, yTile ) == 0:
+        return None
+    xScreen = xScreenOffset + x * tileTotalWidth / 2 - y * tileTotalWidth / 2
+    yScreen = yScreenOffset + y * tileVisibleHeight / 2 + x * tileVisibleHeight / 2 - getHeightAt( xTile , yTile ) * heightMultiplier
+    return agentType[ getAgentAt( xTile, yTile ) ].get_rect( topleft = ( math.floor(xScreen), int(yScreen - heightMultiplier) ) )
+
+def getCellsOverlapping( rect, checked = None ):
+    # returns cells of the view whose display may overlap with rect, in drawing order (back to front). With rect = screen, this is the set of visible cells.
+    # checked (optional) is a dictionary of cells already checked for previous rects: (x,y) => True if overlapping. Only cells not already overlapping previous rects are returned.
+    # cell (x,y) is displayed at u=x-y (horizontal) and s=x+y (vertical). Cells with a large s may still be visible if they are high enough:
+    # search is bounded by the highest possible cell (highest terrain with the highest pile of objects), then cells below rect are checked one by one.
+    noiseMargin = 0
+    if addNoise == True: # height noise moves cells up or down by (a bit more than) one level
+        noiseMargin = 2 * heightMultiplier
+    uMin = math.floor( ( rect.left - xScreenOffset - tileTotalWidth ) / ( tileTotalWidth / 2 ) )
+    uMax = math.ceil( ( rect.right - xScreenOffset ) / ( tileTotalWidth / 2 ) )
+    sMin = math.floor( ( rect.top - yScreenOffset - tileTotalHeight - noiseMargin ) / ( tileVisibleHeight / 2 ) )
+    sMax = math.ceil( ( rect.bottom - yScreenOffset + ( defaultWorld.maxHeightValue + defaultWorld.maxObjectLevel ) * heightMultiplier + noiseMargin ) / ( tileVisibleHeight / 2 ) )
+    sFlat = ( rect.bottom - yScreenOffset + noiseMargin ) / ( tileVisibleHeight / 2 ) # cells with s above this value must be high enough to overlap rect
+    cells = []
+    for y in range( max( 0, ( sMin - uMax ) // 2 ), min( getViewHeight(), ( sMax - uMin ) // 2 + 1 ) ):
+        for x in range( max( 0, uMin + y, sMin - y ), min( getViewWidth(), uMax + y + 1, sMax - y + 1 ) ):
+            if x + y > sFlat:
+                if checked != None and (x,y) in checked:
+                    if checked[(x,y)] == True:
+                        continue
+                    elevation = checked[(x,y)]
                 else:
-                    # v2.
-                    heightNoise = math.sin(it/13+yTile*19) * math.cos(it/17+xTile*41) * heightMultiplier
-                    heightNoise = math.sin(it/199) * heightNoise
+                    elevation = ( getHeightAt(xTileTable[x],yTileTable[y]) + getColumnTop(xTileTable[x],yTileTable[y]) ) * heightMultiplier
+                    if checked != None:
+                        checked[(x,y)] = elevation
+                if ( x + y - sFlat ) * ( tileVisibleHeight / 2 ) >= elevation + 1:
+                    continue
+            elif checked != None and checked.get((x,y)) == True:
+                continue
+            if checked != None:
+                checked[(x,y)] = True
+            cells.append( (x,y) )
+    return cells
+
+def mergeRects( rects ):
+    # merge overlapping rects whenever their union is not larger than their sum (fewer, larger rects are faster to redraw)
+    merged = []
+    for rect in sorted( rects, key = lambda r: (r.top,r.left) ):
+        for i in range(len(merged)-1,max(len(merged)-4,-1),-1): # only look at last merged rects
+            union = merged[i].union(rect)
+            if union.width * union.height <= merged[i].width * merged[i].height + rect.width * rect.height:
+                merged[i] = union
+                break
+        else:
+            merged.append(rect)
+    return merged
+
+def repaintRects( rects, it = 0 ):
+    # clear and redraw some parts of the screen. Cells that overlap these parts are drawn only once, in drawing order, on an off-screen buffer. Then these parts are copied to screen.
+    global repaintBuffer
+    if len(rects) == 0:
+        return
+    rects = mergeRects(rects)
+    if repaintBuffer == None or repaintBuffer.get_size() != screen.get_size():
+        repaintBuffer = pygame.Surface(screen.get_size()).convert()
+    cells = []
+    checked = {}
+    for rect in rects:
+        cells.extend( getCellsOverlapping(rect,checked) )
+    sprites = []
+    for (y,x) in sorted( (y,x) for (x,y) in cells ): # back to front
+        renderCell(x,y,sprites,it)
+    for rect in rects:
+        repaintBuffer.fill((0,0,0),rect)
+    repaintBuffer.blits(sprites,False)
+    screen.blits( [ (repaintBuffer, rect.topleft, rect) for rect in rects ], False )
+    return
+
+def getViewCellRect( x, y, xTile, yTile, previous = None ):
+    # screen area (clipped to screen) covered by cell (x,y) of the view, located at (xTile,yTile) in the world. Also covers area for <previous> (height,column top), if any.
+    rect = getCellRect( x, y, getHeightAt(xTile,yTile), getColumnTop(xTile,yTile) )
+    if previous != None:
+        rect = rect.union( getCellRect( x, y, previous[0], previous[1] ) )
+    return rect.clip( screen.get_rect() )
+
+def getViewBorder( dx, dy ):
+    # cells (x,y) of the view such that (x+dx,y+dy) is out of the view
+    if dx >= 0:
+        columns = range( getViewWidth() - dx, getViewWidth() )
+    else:
+        columns = range( 0, -dx )
+    if dy >= 0:
+        rows = range( getViewHeight() - dy, getViewHeight() )
+    else:
+        rows = range( 0, -dy )
+    cells = [ (x,y) for x in columns for y in range(getViewHeight()) ]
+    cells = cells + [ (x,y) for y in rows for x in range(getViewWidth()) if not x in columns ]
+    return cells
+
+def scrollView( dx, dy, it = 0 ):
+    # view moved by (dx,dy) cells since last frame: re-use last frame by shifting it on screen, then redraw uncovered parts of the screen, cells entering and leaving the view, and modified cells.
+    # returns False if not possible (a full redraw is then needed)
+    global xScreenOffset
+
+    # screen shift must be an integer: since tiles have a non-integer width, the fractional part is compensated by moving xScreenOffset. It is reset (with a full redraw) when drift is larger than one pixel.
+    xShiftExact = - ( dx - dy ) * tileTotalWidth / 2
+    yShiftExact = - ( dx + dy ) * tileVisibleHeight / 2
+    xShift = round( xShiftExact )
+    yShift = round( yShiftExact )
+    if yShift != yShiftExact or abs( xScreenOffset + xShift - xShiftExact - xScreenOffsetReference ) > 1:
+        return False
+    xScreenOffset = xScreenOffset + xShift - xShiftExact
+    updateProjectionTables()
+
+    screen.scroll(xShift,yShift)
+
+    rects = []
+    if xShift > 0: # uncovered areas
+        rects.append( pygame.Rect( 0, 0, xShift, screenHeight ) )
+    elif xShift < 0:
+        rects.append( pygame.Rect( screenWidth + xShift, 0, -xShift, screenHeight ) )
+    if yShift > 0:
+        rects.append( pygame.Rect( 0, 0, screenWidth, yShift ) )
+    elif yShift < 0:
+        rects.append( pygame.Rect( 0, screenHeight + yShift, screenWidth, -yShift ) )
+
+    previousXViewOffset = xViewOffset - dx
+    previousYViewOffset = yViewOffset - dy
+    for (x,y) in getViewBorder(dx,dy): # cells entering the view
+        rects.append( getViewCellRect( x, y, xTileTable[x], yTileTable[y] ) )
+    for (x,y) in getViewBorder(-dx,-dy): # cells leaving the view (displayed at (x-dx,y-dy) after shift)
+        xTile = ( previousXViewOffset + x ) % getWorldWidth()
+        yTile = ( previousYViewOffset + y ) % getWorldHeight()
+        rects.append( getViewCellRect( x - dx, y - dy, xTile, yTile, dirtyCells.get((xTile,yTile)) ) )
+
+    rects = rects + getDirtyRects()
+    repaintRects( [ rect for rect in rects if rect.width > 0 and rect.height > 0 ], it )
+    return True
+
+def getViewPositions( xTile, yTile ):
+    # positions in the view of cell (xTile,yTile) of the world (none if out of view, several if the view is larger than the world)
+    return [ (x,y) for y in range( ( yTile - yViewOffset ) % getWorldHeight(), getViewHeight(), getWorldHeight() ) for x in range( ( xTile - xViewOffset ) % getWorldWidth(), getViewWidth(), getWorldWidth() ) ]
+
+def getDirtyRects():
+    # screen areas covered by cells modified since last frame (before and after modification)
+    rects = []
+    for (xTile,yTile), previous in dirtyCells.items():
+        for (x,y) in getViewPositions(xTile,yTile):
+            rect = getViewCellRect( x, y, xTile, yTile, previous )
+            if rect.width > 0 and rect.height > 0:
+                rects.append(rect)
+    dirtyCells.clear()
+    return rects
+
+def renderLayers( state, it = 0 ):
+    # "layered" mode: copy the pre-rendered static layer, then draw dynamic cells on top (including static elements in front of them)
+    if len(staticLayers) > 0 and next(iter(staticLayers))[2:] != state[2:]: # view surface or scale changed: cached layers are obsolete
+        staticLayers.clear()
+    if not state in staticLayers:
+        if len(staticLayers) >= staticLayerCacheSize:
+            del staticLayers[next(iter(staticLayers))] # forget oldest
+        staticLayer = pygame.Surface((screenWidth, screenHeight)).convert()
+        staticLayer.fill((0,0,0))
+        sprites = []
+        for (x,y) in getCellsOverlapping(screen.get_rect()): # visible cells only
+            renderCell(x,y,sprites,it,"static")
+        staticLayer.blits(sprites,False)
+        staticLayers[state] = staticLayer
+
+    screen.blit(staticLayers[state],(0,0))
+
+    # redraw (all layers) the screen areas covered by dynamic elements
+    screenRect = screen.get_rect()
+    rects = []
+    for (xTile,yTile) in dynamicCells:
+        for (x,y) in getViewPositions(xTile,yTile):
+            rect = getDynamicRect(x,y)
+            if rect != None and rect.colliderect(screenRect):
+                rects.append(rect.clip(screenRect))
+    repaintRects(rects,it)
+    return
 
-            height = getHeightAt( xTile , yTile ) * heightMultiplier + heightNoise
+def getChunkSegments( tileTable, worldSize ):
+    # split a row (or column) of the view into segments of consecutive cells that belong to the same chunk (the world wraps around)
+    # returns list of (first cell in the view, chunk index, first cell in chunk, last cell in chunk + 1)
+    segments = []
+    v = 0
+    while v < len(tileTable):
+        chunk = tileTable[v] // chunkSize
+        start = tileTable[v] - chunk * chunkSize
+        end = min( chunkSize, worldSize - chunk * chunkSize, start + len(tileTable) - v )
+        segments.append( ( v, chunk, start, end ) )
+        v = v + end - start
+    return segments
+
+spriteArrays = weakref.WeakKeyDictionary() # image => ( colors, alphas ), as NumPy arrays indexed by [x,y] (alphas in [0,1])
+
+def getSpriteArrays(image):
+    if not image in spriteArrays:
+        spriteArrays[image] = ( pygame.surfarray.array3d(image).astype(np.float32), pygame.surfarray.array_alpha(image).astype(np.float32) / 255 )
+    return spriteArrays[image]
+
+def fixChunkSurface( surface, blits ):
+    # pixels of a pre-rendered chunk that are only covered by semi-transparent sprite pixels (e.g. rims of tiles on the border of the chunk) are blended with the screen when the chunk is drawn.
+    # Pygame blends semi-transparent pixels on a transparent surface as if it was opaque: fine for one sprite pixel, wrong if several of them are piled up. Such pixels are composed again, so that drawing the chunk is the same as drawing its sprites one by one (cf. renderAll()).
+    surfaceAlphas = pygame.surfarray.pixels_alpha(surface)
+    partial = ( surfaceAlphas > 0 ) & ( surfaceAlphas < 255 )
+    del surfaceAlphas # unlock surface
+    if not partial.any():
+        return
+    index = np.full( partial.shape, -1, np.int32 ) # pixel => index in colors and alphas (-1: pixel not composed again)
+    (xs, ys) = np.nonzero(partial)
+    index[xs,ys] = np.arange(len(xs))
+    colors = np.zeros( (len(xs), 3), np.float32 ) # premultiplied alpha
+    alphas = np.zeros( len(xs), np.float32 )
+    for (image, (x,y)) in blits:
+        (width, height) = image.get_size()
+        imageIndex = index[ x:x+width, y:y+height ]
+        selected = imageIndex >= 0
+        if selected.any():
+            (imageColors, imageAlphas) = getSpriteArrays(image)
+            i = imageIndex[selected]
+            a = imageAlphas[selected]
+            colors[i] = imageColors[selected] * a[:,None] + colors[i] * ( 1 - a[:,None] )
+            alphas[i] = a + alphas[i] * ( 1 - a )
+    pixels = pygame.surfarray.pixels3d(surface)
+    pixels[xs,ys] = np.round( colors / alphas[:,None] ).astype(np.uint8)
+    del pixels
+    surfaceAlphas = pygame.surfarray.pixels_alpha(surface)
+    surfaceAlphas[xs,ys] = np.round( alphas * 255 ).astype(np.uint8)
+    del surfaceAlphas
+    return
 
+def getChunkSurface( xChunk, yChunk, xStart, xEnd, yStart, yEnd, xFraction, yFraction ):
+    # returns pre-rendered terrain and objects of cells [xStart,xEnd[ x [yStart,yEnd[ of a chunk, as (surface, offset of surface w.r.t. the first cell)
+    # (xFraction,yFraction) is the fractional part of the screen position of the first cell, so that the result is the same as drawing cells one by one
+    global chunkSurfacesMemory
+    key = ( xChunk, yChunk, xStart, xEnd, yStart, yEnd, xFraction, yFraction, scaleMultiplier )
+    if key in chunkSurfaces:
+        chunkSurfaces.move_to_end(key)
+        return chunkSurfaces[key]
+
+    sprites = []
+    for y in range(yStart,yEnd):
+        for x in range(xStart,xEnd):
+            xTile = xChunk * chunkSize + x
+            yTile = yChunk * chunkSize + y
+            xScreen = math.floor( xFraction + ( x - xStart ) * tileTotalWidth / 2 - ( y - yStart ) * tileTotalWidth / 2 )
+            yScreen = yFraction + ( y - yStart ) * tileVisibleHeight / 2 + ( x - xStart ) * tileVisibleHeight / 2 - getHeightAt( xTile , yTile ) * heightMultiplier
+            addCellSprites( xTile, yTile, xScreen, yScreen, sprites, "objects" )
+    sprites = [ ( image, ( x, math.floor(y) ) ) for (image, (x,y)) in sprites ]
+    left = min( x for (image, (x,y)) in sprites )
+    top = min( y for (image, (x,y)) in sprites )
+    right = max( x + image.get_width() for (image, (x,y)) in sprites )
+    bottom = max( y + image.get_height() for (image, (x,y)) in sprites )
+    blits = [ ( image, ( x - left, y - top ) ) for (image, (x,y)) in sprites ]
+    surface = pygame.Surface( ( right - left, bottom - top ), SRCALPHA )
+    surface.blits( blits, False )
+    fixChunkSurface( surface, blits )
+
+    chunkSurfaces[key] = ( surface, (left, top) )
+    chunkKeys.setdefault( (xChunk, yChunk), set() ).add(key)
+    chunkSurfacesMemory = chunkSurfacesMemory + surface.get_pitch() * surface.get_height()
+    while chunkSurfacesMemory > chunkCacheBudget and len(chunkSurfaces) > 1:
+        oldKey, (oldSurface, oldOffset) = chunkSurfaces.popitem(last=False)
+        chunkKeys[ oldKey[:2] ].discard(oldKey)
+        chunkSurfacesMemory = chunkSurfacesMemory - oldSurface.get_pitch() * oldSurface.get_height()
+    return chunkSurfaces[key]
+
+def renderChunks( it = 0 ):
+    # "chunked" mode: draw pre-rendered chunks of the world (one blit per visible chunk, back to front), then agents on top
+    # chunks crossing the border of the view (or the border of the world) are pre-rendered separately for the part inside the view.
+    screen.fill((0,0,0))
+    screenRect = screen.get_rect()
+    elevation = ( defaultWorld.maxHeightValue + defaultWorld.maxObjectLevel ) * heightMultiplier
+    blits = []
+    for (y, yChunk, yStart, yEnd) in getChunkSegments( yTileTable, getWorldHeight() ):
+        for (x, xChunk, xStart, xEnd) in getChunkSegments( xTileTable, getWorldWidth() ):
             xScreen = xScreenOffset + x * tileTotalWidth / 2 - y * tileTotalWidth / 2
-            yScreen = yScreenOffset + y * tileVisibleHeight / 2 + x * tileVisibleHeight / 2 - height
+            yScreen = yScreenOffset + y * tileVisibleHeight / 2 + x * tileVisibleHeight / 2
+            # screen area that may be covered by this chunk (whatever its content). Skip it if not visible.
+            left = math.floor( xScreen - ( yEnd - yStart - 1 ) * tileTotalWidth / 2 ) - 1
+            right = math.ceil( xScreen + ( xEnd - xStart + 1 ) * tileTotalWidth / 2 ) + 1
+            top = math.floor( yScreen - elevation ) - 1
+            bottom = math.ceil( yScreen + ( xEnd - xStart + yEnd - yStart - 2 ) * tileVisibleHeight / 2 + tileTotalHeight ) + 1
+            if not screenRect.colliderect( pygame.Rect( left, top, right - left, bottom - top ) ):
+                continue
+            (surface, offset) = getChunkSurface( xChunk, yChunk, xStart, xEnd, yStart, yEnd, xScreen - math.floor(xScreen), yScreen - math.floor(yScreen) )
+            blits.append( ( surface, ( math.floor(xScreen) + offset[0], math.floor(yScreen) + offset[1] ) ) )
+    screen.blits(blits,False)
+
+    # redraw (all layers) the screen areas covered by agents
+    rects = []
+    for (xTile,yTile) in agentCells:
+        for (x,y) in getViewPositions(xTile,yTile):
+            rect = getAgentRect(x,y)
+            if rect.colliderect(screenRect):
+                rects.append(rect.clip(screenRect))
+    repaintRects(rects,it)
+    return
 
-            screen.blit( tileType[ getTerrainAt( xTile , yTile ) ] , (xScreen, yScreen)) # display terrain
+def renderAll( it = 0 ):
+    # redraw the whole screen
+    pygame.draw.rect(screen, (0,0,0), (0, 0, screenWidth, screenHeight), 0) # overkill - can be optimized. (most sprites are already "naturally" overwritten)
+    #pygame.display.update()
 
-            for level in range(objectMapLevels):
-                if getObjectAt( xTile , yTile , level)  > 0: # object on terrain?
-                    screen.blit( objectType[ getObjectAt( xTile , yTile, level) ] , (xScreen, yScreen - heightMultiplier*(level+1) ))
+    sprites = []
+    for (x,y) in getCellsOverlapping(screen.get_rect()): # visible cells only
+        renderCell(x,y,sprites,it)
+    screen.blits(sprites,False)
+    return
 
-            if getAgentAt( xTile, yTile ) != 0: # agent on terrain?
-                screen.blit( agentType[ getAgentAt( xTile, yTile ) ] , (xScreen, yScreen - heightMultiplier ))
+def saveSnapshot( filename, it = 0 ):
+    # redraw the whole screen (whatever the rendering mode) and save it to an image file. Can be used in headless mode.
+    global renderState
+    if len(tileType) == 0: # headless mode: sprites are loaded only when needed
+        loadAllImages()
+    updateProjectionTables()
+    renderAll(it)
+    renderState = None # screen content is not known by render() anymore
+    pygame.image.save(screen,filename)
+    return
 
+def resetRendering():
+    # forget everything known about the displayed world (e.g. when the default world has been loaded from a file): next frame is fully redrawn
+    global renderState, chunkSurfacesMemory
+    renderState = None
+    dirtyCells.clear()
+    staticLayers.clear()
+    chunkSurfaces.clear()
+    chunkKeys.clear()
+    chunkSurfacesMemory = 0
+    dynamicCells.clear()
+    agentCells.clear()
+    cells = findCells( defaultWorld.agentMap ) + findCells( defaultWorld.objectMap, dynamicObjectIds ) + list( defaultWorld.objectStacks )
+    for (x,y) in cells:
+        updateDynamicCell(x,y)
     return
 
+def render( it = 0 ):
+    # returns None if the whole screen has been redrawn (call pygame.display.flip()), or the list of screen areas that have been redrawn (call pygame.display.update(rects))
+    global renderState, xScreenOffset
+
+    state = ( xViewOffset, yViewOffset, getViewWidth(), getViewHeight(), scaleMultiplier )
+
+    updateProjectionTables()
+
+    for (x,y) in dirtyCells: # cells modified since last frame may have become (or may not be anymore) dynamic
+        updateDynamicCell(x,y)
+
+    if renderMode == "layered" and addNoise == False:
+        renderLayers(state,it)
+        dirtyCells.clear()
+        return None
+
+    if renderMode == "chunked" and addNoise == False:
+        renderChunks(it)
+        dirtyCells.clear()
+        return None
+
+    if renderMode == "dirty" and addNoise == False and renderState != None and state != renderState and state[2:] == renderState[2:]: # view moved: scroll
+        dx = ( xViewOffset - renderState[0] + getWorldWidth() + getWorldWidth() // 2 ) % getWorldWidth() - getWorldWidth() // 2
+        dy = ( yViewOffset - renderState[1] + getWorldHeight() + getWorldHeight() // 2 ) % getWorldHeight() - getWorldHeight() // 2
+        if abs(dx) < getViewWidth() / 2 and abs(dy) < getViewHeight() / 2 and scrollView(dx,dy,it) == True:
+            renderState = state
+            return None
+        xScreenOffset = xScreenOffsetReference
+        updateProjectionTables()
+
+    if renderMode != "dirty" or addNoise == True or state != renderState:
+        renderState = state
+        dirtyCells.clear()
+        renderAll(it)
+        return None
+
+    # dirty mode: only redraw areas covered by modified cells (before and after modification)
+    rects = getDirtyRects()
+    repaintRects(rects,it)
+
+    return rects
+
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
@@ -339,46 +968,55 @@ def render( it = 0 ):
 
 class BasicAgent:
 
-    def __init__(self,imageId):
+    def __init__(self,imageId,world=None,position=None): # agent lives in <world> (default: the default world). If position (x,y) is given, agent is already on the world map (e.g. world loaded from file).
         self.type = imageId
-        self.reset()
+        if world == None:
+            world = defaultWorld
+        self.world = world
+        if position == None:
+            self.reset()
+        else:
+            (self.x,self.y) = position
         return
 
     def reset(self):
-        self.x = randint(0,getWorldWidth()-1)
-        self.y = randint(0,getWorldWidth()-1)
-        while getTerrainAt(self.x,self.y) != 0 or getObjectAt(self.x,self.y) != 0 or getAgentAt(self.x,self.y) != 0:
-            self.x = randint(0,getWorldWidth()-1)
-            self.y = randint(0,getWorldHeight()-1)
-        setAgentAt(self.x,self.y,self.type)
+        world = self.world
+        self.x = world.random.randint(0,world.getWidth()-1)
+        self.y = world.random.randint(0,world.getHeight()-1)
+        while world.getTerrainAt(self.x,self.y) != 0 or world.getObjectAt(self.x,self.y) != 0 or world.getAgentAt(self.x,self.y) != 0:
+            self.x = world.random.randint(0,world.getWidth()-1)
+            self.y = world.random.randint(0,world.getHeight()-1)
+        world.setAgentAt(self.x,self.y,self.type)
         return
 
     def getPosition(self):
         return (self.x,self.y)
 
     def move(self):
+        world = self.world
         xNew = self.x
         yNew = self.y
-        if random() < 0.5:
-            xNew = ( self.x + [-1,+1][randint(0,1)] + getWorldWidth() ) % getWorldWidth()
+        if world.random.random() < 0.5:
+            xNew = ( self.x + [-1,+1][world.random.randint(0,1)] + world.getWidth() ) % world.getWidth()
         else:
-            yNew = ( self.y + [-1,+1][randint(0,1)] + getWorldHeight() ) % getWorldHeight()
-        if getObjectAt(xNew,yNew) == 0: # dont move if collide with object (note that negative values means cell cannot be walked on)
-            setAgentAt(self.x,self.y,noAgentId)
+            yNew = ( self.y + [-1,+1][world.random.randint(0,1)] + world.getHeight() ) % world.getHeight()
+        if world.getObjectAt(xNew,yNew) == 0: # dont move if collide with object (note that negative values means cell cannot be walked on)
+            world.setAgentAt(self.x,self.y,noAgentId)
             self.x = xNew
             self.y = yNew
-            setAgentAt(self.x,self.y,self.type)
+            world.setAgentAt(self.x,self.y,self.type)
         if verbose == True:
             print ("agent of type ",str(self.type),"located at (",self.x,",",self.y,")")
         return
 
     def move2(self,xNew,yNew):
+        world = self.world
         success = False
-        if getObjectAt( (self.x+xNew+worldWidth)%worldWidth , (self.y+yNew+worldHeight)%worldHeight ) == 0: # dont move if collide with object (note that negative values means cell cannot be walked on)
-            setAgentAt( self.x, self.y, noAgentId)
-            self.x = ( self.x + xNew + worldWidth ) % worldWidth
-            self.y = ( self.y + yNew + worldHeight ) % worldHeight
-            setAgentAt( self.x, self.y, self.type)
+        if world.getObjectAt( (self.x+xNew+world.getWidth())%world.getWidth() , (self.y+yNew+world.getHeight())%world.getHeight() ) == 0: # dont move if collide with object (note that negative values means cell cannot be walked on)
+            world.setAgentAt( self.x, self.y, noAgentId)
+            self.x = ( self.x + xNew + world.getWidth() ) % world.getWidth()
+            self.y = ( self.y + yNew + world.getHeight() ) % world.getHeight()
+            world.setAgentAt( self.x, self.y, self.type)
             success = True
         if verbose == True:
             if success == False:
@@ -390,7 +1028,1273 @@ class BasicAgent:
     def getType(self):
         return self.type
 
-agents = []
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
+### Kernels
+###
+###
+
+# step loops on NumPy arrays, compiled by Numba if installed (otherwise, they still work as plain Python functions, only slower). They give the same results as the Python code (cf. checkKernels()).
+
+kernelsChecked = None # None: kernels not checked yet ; True/False: result of checkKernels() (kernels are only used if True)
+
+def compileKernel(function):
+    if numba == None:
+        return function
+    return numba.njit(function)
+
+@compileKernel
+def getRandomWord(state):
+    # next 32-bit value of the Mersenne Twister, as used by Python's random generator. state is an array of 625 int64, as in Random.getstate(): 624 words and index of the next word (modified).
+    i = state[624]
+    if i >= 624:
+        for k in range(624):
+            y = ( state[k] & 0x80000000 ) | ( state[(k+1)%624] & 0x7fffffff )
+            value = state[(k+397)%624] ^ ( y >> 1 )
+            if y & 1 == 1:
+                value = value ^ 0x9908b0df
+            state[k] = value
+        i = 0
+    y = state[i]
+    state[624] = i + 1
+    y = y ^ ( y >> 11 )
+    y = y ^ ( ( y << 7 ) & 0x9d2c5680 )
+    y = y ^ ( ( y << 15 ) & 0xefc60000 )
+    y = y ^ ( y >> 18 )
+    return y
+
+@compileKernel
+def getRandomFloat(state): # same as Random.random()
+    a = getRandomWord(state) >> 5
+    b = getRandomWord(state) >> 6
+    return ( a * 67108864.0 + b ) * ( 1.0 / 9007199254740992.0 )
+
+@compileKernel
+def getRandomBelow(state,n): # same as Random.randrange(n), for 0 < n < 2**32
+    k = 0
+    while ( n >> k ) > 0: # k is the number of bits of n
+        k += 1
+    r = getRandomWord(state) >> ( 32 - k )
+    while r >= n:
+        r = getRandomWord(state) >> ( 32 - k )
+    return r
+
+@compileKernel
+def burnKernel(xs,ys,objects,agents,treeId,burningTreeId,ghostId,changes):
+    # same as World.stepFireScan() on arrays: trees (xs[i],ys[i]) are visited in this order (by column, then row). Only trees and their neighbours are read, so that time does not depend on the world size.
+    # Trees set on fire are written in objects (so that trees visited later catch fire from them) and in changes (array of n x 2), in order. Returns their number.
+    (height, width) = objects.shape
+    n = 0
+    for i in range(len(xs)):
+        x = xs[i]
+        y = ys[i]
+        if objects[y,x] == treeId:
+            for (dx,dy) in ((-1,0),(1,0),(0,-1),(0,1)):
+                if objects[(y+dy+height)%height,(x+dx+width)%width] == burningTreeId or agents[(y+dy+height)%height,(x+dx+width)%width] == ghostId:
+                    objects[y,x] = burningTreeId
+            if objects[y,x] == burningTreeId:
+                changes[n,0] = x
+                changes[n,1] = y
+                n += 1
+    return n
+
+@compileKernel
+def moveAgentsKernel(state,xs,ys,types,objects,agents):
+    # same as World.stepAgents() on arrays: shuffle agents, then move each of them as BasicAgent.move() does. Agent i is at (xs[i],ys[i]) and has type types[i] (xs, ys, agents and random state are modified).
+    # Returns the new order of agents (indices).
+    (height, width) = objects.shape
+    order = np.arange(len(xs))
+    for i in range(len(xs)-1,0,-1):
+        j = getRandomBelow(state,i+1)
+        (order[i], order[j]) = (order[j], order[i])
+    for i in order:
+        xNew = xs[i]
+        yNew = ys[i]
+        if getRandomFloat(state) < 0.5:
+            xNew = ( xs[i] + ( 2 * getRandomBelow(state,2) - 1 ) + width ) % width
+        else:
+            yNew = ( ys[i] + ( 2 * getRandomBelow(state,2) - 1 ) + height ) % height
+        if objects[yNew,xNew] == 0:
+            agents[ys[i],xs[i]] = noAgentId
+            xs[i] = xNew
+            ys[i] = yNew
+            agents[yNew,xNew] = types[i]
+    return order
+
+def checkKernels(nbTicks=300):
+    # check that kernels give the same results as the Python code: two worlds with the same seed are stepped for nbTicks ticks, one with kernels, one without. Returns True if they are identical.
+    worlds = [ World(seed=1,storage="dense"), World(seed=1,storage="dense") ]
+    for world in worlds:
+        world.initWorld()
+    for it in range(0,nbTicks,3):
+        worlds[0].stepFireScan()
+        worlds[0].random.shuffle(worlds[0].agents)
+        for a in worlds[0].agents:
+            a.move()
+        worlds[1].stepFireKernel()
+        worlds[1].moveAgentsKernel()
+        for world in worlds:
+            world.agents.append(BasicAgent(ghostId,world))
+    states = [ ( world.objectMap.tolist(), world.agentMap.tolist(), [ ( a.getType(), a.x, a.y ) for a in world.agents ], world.random.getstate() ) for world in worlds ]
+    return states[0] == states[1]
+
+def kernelsEnabled():
+    # kernels are used if Numba is installed, useKernels is True and kernels give the same results as the Python code (checked on first use)
+    global kernelsChecked
+    if useKernels == False or numba == None:
+        return False
+    if kernelsChecked == None:
+        kernelsChecked = checkKernels()
+        if kernelsChecked == False:
+            print ("[WARNING] kernels do not give the same results as the Python code: kernels are not used.")
+    return kernelsChecked
+
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
+### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
+### World
+###
+###
+
+class ChunkedGrid:
+    # 2D grid of cells, allocated by chunks of chunkSize x chunkSize cells on first write of a non-zero value. Cells of unallocated chunks are 0.
+    # Cells are accessed as in a NumPy array: grid.item(y,x) and grid[y,x] = value (this is the only supported indexing).
+    # Chunks are copied on write: fork() returns a grid sharing all its chunks, which are copied by each grid only when it writes to them.
+
+    def __init__(self,shape,dtype,chunkSize=storageChunkSize):
+        self.shape = shape # (height,width)
+        self.dtype = np.dtype(dtype)
+        self.chunkSize = chunkSize
+        self.chunks = {} # (chunk x, chunk y) => NumPy array of chunkSize x chunkSize cells, indexed by [y,x]
+        self.ownChunks = set() # keys of chunks that can be written, ie. not shared with other grids (cf. fork())
+        return
+
+    def item(self,y,x):
+        chunk = self.chunks.get( ( x // self.chunkSize, y // self.chunkSize ) )
+        if chunk is None:
+            return 0
+        return chunk.item( y % self.chunkSize, x % self.chunkSize )
+
+    def __setitem__(self,index,value):
+        (y,x) = index
+        key = ( x // self.chunkSize, y // self.chunkSize )
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            if value == 0: # nothing to write
+                return
+            chunk = self.chunks[key] = np.zeros( (self.chunkSize, self.chunkSize), dtype=self.dtype )
+            self.ownChunks.add(key)
+        elif key not in self.ownChunks: # shared chunk: copy it first
+            chunk = self.chunks[key] = chunk.copy()
+            self.ownChunks.add(key)
+        chunk[ y % self.chunkSize, x % self.chunkSize ] = value
+
+    def getCells(self,rows,columns):
+        # cells at rows x columns (arrays of indices, e.g. a chunk with its neighbours), as a NumPy array indexed by [row,column]
+        cells = np.zeros( (len(rows), len(columns)), dtype=self.dtype )
+        columnRuns = self.getRuns(columns)
+        for (i0, i1, yChunk, y) in self.getRuns(rows):
+            for (j0, j1, xChunk, x) in columnRuns:
+                chunk = self.chunks.get( (xChunk,yChunk) )
+                if chunk is not None:
+                    cells[ i0:i1, j0:j1 ] = chunk[ y : y + i1 - i0, x : x + j1 - j0 ]
+        return cells
+
+    def getRuns(self,indices):
+        # split indices into runs of consecutive indices in the same chunk: list of (first position, last position + 1, chunk, first index in chunk)
+        indices = indices.tolist()
+        runs = []
+        start = 0
+        for i in range( 1, len(indices) + 1 ):
+            if i == len(indices) or indices[i] != indices[i-1] + 1 or indices[i] // self.chunkSize != indices[start] // self.chunkSize:
+                runs.append( ( start, i, indices[start] // self.chunkSize, indices[start] % self.chunkSize ) )
+                start = i
+        return runs
+
+    def fork(self):
+        # new grid with the same cells, sharing all chunks with this grid (copy-on-write)
+        grid = ChunkedGrid( self.shape, self.dtype, self.chunkSize )
+        grid.chunks = dict(self.chunks)
+        self.ownChunks = set() # chunks are now shared
+        return grid
+
+    def __array__(self,dtype=None,copy=None): # whole grid as a NumPy array (allocates all cells)
+        array = np.zeros( self.shape, dtype=self.dtype if dtype == None else dtype )
+        for (xChunk,yChunk), chunk in self.chunks.items():
+            x = xChunk * self.chunkSize
+            y = yChunk * self.chunkSize
+            array[ y : y + self.chunkSize, x : x + self.chunkSize ] = chunk[ : self.shape[0] - y, : self.shape[1] - x ]
+        return array
+
+class CellSet:
+    # set of cells (x,y), stored by chunks of chunkSize x chunkSize cells: one array of booleans for each chunk holding at least one cell (cf. World.objectCells). Memory is bounded by the size of the maps, and listing cells takes time proportional to the number of chunks holding cells.
+    # Chunks are copied on write, as ChunkedGrid: fork() returns a set sharing all its chunks, which are copied by each set only when it writes to them.
+
+    def __init__(self,chunkSize=storageChunkSize):
+        self.chunkSize = chunkSize
+        self.chunks = {} # (chunk x, chunk y) => NumPy array of chunkSize x chunkSize booleans, indexed by [y,x]
+        self.counts = {} # (chunk x, chunk y) => number of cells of this chunk in the set (empty chunks are dropped)
+        self.cells = {} # (chunk x, chunk y) => cells of this chunk, as an array of offsets x * chunkSize + y in the chunk, sorted (computed when first listed, dropped when the chunk is written. Cf. getCellArrays())
+        self.ownChunks = set() # keys of chunks that can be written, ie. not shared with other sets (cf. fork())
+        self.size = 0 # number of cells
+        return
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self,cell):
+        (x,y) = cell
+        chunk = self.chunks.get( ( x // self.chunkSize, y // self.chunkSize ) )
+        return chunk is not None and chunk.item( y % self.chunkSize, x % self.chunkSize )
+
+    def __iter__(self):
+        return iter( self.getCells() )
+
+    def getOwnChunk(self,key):
+        # chunk <key>, to be modified: created if needed, copied first if shared with a fork
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = np.zeros( (self.chunkSize, self.chunkSize), dtype=np.bool_ )
+            self.counts[key] = 0
+            self.ownChunks.add(key)
+        elif key not in self.ownChunks:
+            chunk = self.chunks[key] = chunk.copy()
+            self.ownChunks.add(key)
+        self.cells.pop(key,None)
+        return chunk
+
+    def add(self,x,y):
+        key = ( x // self.chunkSize, y // self.chunkSize )
+        chunk = self.chunks.get(key)
+        if chunk is None or not chunk.item( y % self.chunkSize, x % self.chunkSize ):
+            self.getOwnChunk(key)[ y % self.chunkSize, x % self.chunkSize ] = True
+            self.counts[key] += 1
+            self.size += 1
+        return
+
+    def discard(self,x,y):
+        key = ( x // self.chunkSize, y // self.chunkSize )
+        chunk = self.chunks.get(key)
+        if chunk is None or not chunk.item( y % self.chunkSize, x % self.chunkSize ):
+            return
+        self.size -= 1
+        self.counts[key] -= 1
+        if self.counts[key] == 0: # forget empty chunks
+            del self.chunks[key]
+            del self.counts[key]
+            self.cells.pop(key,None)
+            self.ownChunks.discard(key)
+        else:
+            self.getOwnChunk(key)[ y % self.chunkSize, x % self.chunkSize ] = False
+        return
+
+    def addCells(self,x0,y0,mask):
+        # add all cells where 2D boolean array <mask> is True (mask[0,0] is cell (x0,y0)), chunk by chunk (e.g. to index a block of a map, cf. World.indexObjects())
+        size = self.chunkSize
+        (height, width) = mask.shape
+        for yChunk in range( y0 // size, ( y0 + height - 1 ) // size + 1 ):
+            (ya, yb) = ( max( y0, yChunk * size ), min( y0 + height, ( yChunk + 1 ) * size ) )
+            for xChunk in range( x0 // size, ( x0 + width - 1 ) // size + 1 ):
+                (xa, xb) = ( max( x0, xChunk * size ), min( x0 + width, ( xChunk + 1 ) * size ) )
+                cells = mask[ ya - y0 : yb - y0, xa - x0 : xb - x0 ]
+                if cells.any():
+                    key = (xChunk,yChunk)
+                    part = self.getOwnChunk(key)[ ya - yChunk * size : yb - yChunk * size, xa - xChunk * size : xb - xChunk * size ]
+                    n = np.count_nonzero( cells & ~part )
+                    part |= cells
+                    self.counts[key] += n
+                    self.size += n
+        return
+
+    def getChunkCells(self,key):
+        # offsets of the cells of chunk <key> (cf. cells)
+        cells = self.cells.get(key)
+        if cells is None:
+            (x, y) = np.nonzero( self.chunks[key].T ) # column by column
+            cells = self.cells[key] = ( x * self.chunkSize + y ).astype( np.min_scalar_type( self.chunkSize * self.chunkSize ) )
+        return cells
+
+    def getCellArrays(self):
+        # (xs,ys) arrays of the cells of the set, sorted by column, then row. Only chunks written since the last call are visited cell by cell.
+        if self.size == 0:
+            return np.zeros( 0, dtype=np.int64 ), np.zeros( 0, dtype=np.int64 )
+        keys = list(self.chunks)
+        cells = np.concatenate( [ self.getChunkCells(key) for key in keys ] ).astype(np.int64)
+        origins = np.repeat( np.array( keys, dtype=np.int64 ) * self.chunkSize, [ self.counts[key] for key in keys ], axis=0 )
+        cells = np.sort( ( ( cells // self.chunkSize + origins[:,0] ) << 32 ) + cells % self.chunkSize + origins[:,1] ) # (x,y) as a single number, ordered as (x,y)
+        return cells >> 32, cells & 0xffffffff
+
+    def getCells(self):
+        # cells of the set, as a list of (x,y) sorted by column, then row (ie. as sorted() would)
+        (xs, ys) = self.getCellArrays()
+        return list( zip( xs.tolist(), ys.tolist() ) )
+
+    def fork(self):
+        # new set with the same cells, sharing all chunks with this set (copy-on-write)
+        cells = CellSet(self.chunkSize)
+        cells.chunks = dict(self.chunks)
+        cells.counts = dict(self.counts)
+        cells.cells = dict(self.cells) # (arrays are replaced, never modified)
+        cells.size = self.size
+        self.ownChunks = set() # chunks are now shared
+        return cells
+
+sharedBlocks = {} # address of data => shared memory block (multiprocessing.shared_memory.SharedMemory), for grids in shared memory. Blocks are released when their grid is dropped.
+
+def getSharedBlock(grid): # shared memory block of grid (None if grid is not in shared memory)
+    if not isinstance(grid,np.ndarray):
+        return None
+    return sharedBlocks.get( grid.__array_interface__["data"][0] )
+
+def releaseSharedBlock(address):
+    block = sharedBlocks.pop( address, None )
+    if block != None:
+        block.close()
+        block.unlink()
+    return
+
+def makeGrid(shape,dtype,storage=worldStorage):
+    # 2D grid of cells, initially 0: NumPy array (storage is "dense"), ChunkedGrid (storage is "chunked"), NumPy memory-mapped array on a new file of worldDirectory (storage is "memmap") or NumPy array in shared memory (storage is "shared"). All are indexed by [y,x].
+    if storage == "shared":
+        block = shared_memory.SharedMemory( create=True, size=max( 1, shape[0] * shape[1] * np.dtype(dtype).itemsize ) ) # filled with 0
+        grid = np.ndarray( shape, dtype=dtype, buffer=block.buf )
+        sharedBlocks[ grid.__array_interface__["data"][0] ] = block
+        weakref.finalize( grid, releaseSharedBlock, grid.__array_interface__["data"][0] ) # released when the grid is dropped, or when the program exits
+        return grid
+    if storage == "chunked":
+        return ChunkedGrid(shape,dtype)
+    if storage == "memmap":
+        os.makedirs(worldDirectory,exist_ok=True)
+        (handle, filename) = tempfile.mkstemp( prefix="map_", suffix=".dat", dir=worldDirectory )
+        os.close(handle)
+        grid = np.memmap( filename, dtype=dtype, mode="w+", shape=shape ) # sparse file: disk space is only used for parts actually written
+        weakref.finalize( grid, removeFile, filename ) # temporary file: removed when the grid is dropped, or when the program exits
+        return grid
+    return np.zeros(shape,dtype=dtype)
+
+def forkGrid(grid):
+    # new grid with the same cells: shares chunks with grid (ChunkedGrid, copy-on-write), or is a copy (NumPy array, memory-mapped array on a new file, or in new shared memory)
+    if isinstance(grid,ChunkedGrid):
+        return grid.fork()
+    if isinstance(grid,np.memmap):
+        copy = makeGrid( grid.shape, grid.dtype, "memmap" )
+        copyToMemmap(grid,copy)
+        return copy
+    if getSharedBlock(grid) != None:
+        copy = makeGrid( grid.shape, grid.dtype, "shared" )
+        copy[:] = grid
+        return copy
+    return grid.copy()
+
+def removeFile(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+    return
+
+def copyToMemmap(source,destination):
+    # copy all cells of grid <source> into memory-mapped grid <destination> (same shape, new file, ie. all 0). Blocks of rows that are all 0 are skipped, so that the file stays sparse.
+    rows = max( 1, ( 1024 * 1024 ) // ( source.shape[1] * source.itemsize ) ) # blocks of about 1 MB
+    for y in range( 0, source.shape[0], rows ):
+        block = source[ y : y + rows ]
+        if block.any():
+            destination[ y : y + rows ] = block
+    destination.flush()
+    return
+
+def removeWorldFile(filename):
+    # remove a file written by saveWorld(), and the copies of its memory-mapped maps (cf. gridToArrays())
+    for name in ( "terrain", "height", "object", "agent", "columnHeight" ):
+        removeFile( os.path.splitext(filename)[0] + "_" + name + ".dat" )
+    removeFile(filename)
+    return
+
+def gridToArrays(grid,name,arrays,filename):
+    # store grid into dictionary of NumPy arrays <arrays> (as saved in .npz file <filename>): whole grid, or allocated chunks only (ChunkedGrid), or name of a copy of its file (memory-mapped grid: the copy is written next to <filename>)
+    if isinstance(grid,np.memmap):
+        mapFilename = os.path.splitext(filename)[0] + "_" + name + ".dat"
+        removeFile(mapFilename)
+        copyToMemmap( grid, np.memmap( mapFilename, dtype=grid.dtype, mode="w+", shape=grid.shape ) )
+        arrays[name+"File"] = np.array( os.path.abspath(mapFilename) )
+    elif isinstance(grid,ChunkedGrid):
+        keys = sorted(grid.chunks)
+        arrays[name+"ChunkKeys"] = np.array( keys, dtype=np.int64 ).reshape( len(keys), 2 )
+        arrays[name+"Chunks"] = np.array( [ grid.chunks[key] for key in keys ], dtype=grid.dtype ).reshape( len(keys), grid.chunkSize, grid.chunkSize )
+    else:
+        arrays[name] = grid
+    return
+
+def gridFromArrays(arrays,name,shape,dtype):
+    # restore grid stored by gridToArrays()
+    if name+"File" in arrays: # memory-mapped grid: copied to a new file (the saved file is never modified)
+        grid = makeGrid( shape, dtype, "memmap" )
+        copyToMemmap( np.memmap( arrays[name+"File"].item(), dtype=dtype, mode="r", shape=shape ), grid )
+        return grid
+    if name+"ChunkKeys" in arrays:
+        chunks = arrays[name+"Chunks"]
+        grid = ChunkedGrid( shape, dtype, chunks.shape[1] )
+        grid.chunks = { (xChunk,yChunk): chunk for ((xChunk,yChunk), chunk) in zip( arrays[name+"ChunkKeys"].tolist(), chunks ) }
+        grid.ownChunks = set(grid.chunks)
+        return grid
+    if worldStorage == "shared": # keep maps in shared memory
+        grid = makeGrid( shape, dtype, "shared" )
+        grid[:] = arrays[name]
+        return grid
+    return np.array( arrays[name], dtype=dtype )
+
+def findCells(grid,values=None):
+    # cells (x,y) of grid with one of the given values (default: any non-zero value)
+    if isinstance(grid,ChunkedGrid):
+        # one nonzero per chunk, shifted by the chunk's offset, then a single conversion to a list
+        xsChunks = [ np.zeros( 0, dtype=np.intp ) ]
+        ysChunks = [ np.zeros( 0, dtype=np.intp ) ]
+        for (xChunk,yChunk), chunk in grid.chunks.items():
+            (ys,xs) = findCellArrays(chunk,values)
+            xsChunks.append( xs + xChunk * grid.chunkSize )
+            ysChunks.append( ys + yChunk * grid.chunkSize )
+        return list( zip( np.concatenate(xsChunks).tolist(), np.concatenate(ysChunks).tolist() ) )
+    (ys,xs) = findCellArrays(grid,values)
+    return list( zip( xs.tolist(), ys.tolist() ) )
+
+def findCellArrays(grid,values=None):
+    # (ys,xs) arrays of the cells of 2D array grid with one of the given values (default: any non-zero value)
+    if values == None:
+        return np.nonzero(grid)
+    return np.nonzero( np.isin(grid,values) )
+
+def countNeighbours(mask):
+    # number of neighbours (4-neighbourhood, toroidal world) where mask is True, for each cell of a 2D boolean array
+    counts = np.zeros( mask.shape, dtype=np.uint8 )
+    for (shift,axis) in ((1,0),(-1,0),(1,1),(-1,1)):
+        counts += np.roll(mask,shift,axis)
+    return counts
+
+def getRandomArray(world,shape):
+    # uniform random values in [0,1[ for the cells of the maps given to stencil rules (shape is their shape), e.g. for probabilistic rules.
+    # The value of a cell only depends on the seed and tick of the step, on the cell's coordinates in the world and on the number of previous calls in this step: chunks, strips and the whole world see the same values (cf. getStencilWorld()).
+    # Values are drawn from a counter-based generator (Philox) whose counter is the index of the cell in the world (y * width + x), so that runs of consecutive cells are drawn at once.
+    if world.randomValue != None: # rules are probed (cf. changesEmptyCells())
+        world.draws += 1
+        return np.full( shape, world.randomValue )
+    index = ( world.rows.reshape(-1,1) * world.width + world.columns ).ravel()
+    starts = np.flatnonzero( np.diff( index, prepend=-2 ) != 1 ) # first cells of runs of consecutive cells
+    ends = np.append( starts[1:], len(index) )
+    key = np.array( [ world.seed, world.tick ], dtype=np.uint64 )
+    values = np.empty( len(index) )
+    for (start, end, first) in zip( starts.tolist(), ends.tolist(), index[starts].tolist() ):
+        generator = np.random.Generator( np.random.Philox( key=key, counter=np.array( [ first // 4, world.draws, 0, 0 ], dtype=np.uint64 ) ) ) # (Philox draws values by blocks of 4)
+        values[start:end] = generator.random( first % 4 + end - start )[ first % 4 : ]
+    world.draws += 1
+    return values.reshape(shape)
+
+def burnRule(world,objects,agents):
+    # trees next to a burning tree or a ghost catch fire
+    return ( objects == treeId ) & ( countNeighbours( objects == burningTreeId ) + countNeighbours( agents == ghostId ) > 0 ), burningTreeId
+
+# rules of the "stencil" fire engine (cf. World.stepStencil()): rule(world,objects,agents) returns (mask,value), ie. cells where the object on level 0 becomes value (a number, or an array of the same shape).
+# objects and agents are the maps *before* the step (arrays indexed by [y,x], not to be modified), so that rules do not depend on each other or on cell order. When several rules apply to a cell, the last one wins.
+# Example (trees grow back on 1% of empty grass cells): stencilRules.append( lambda world, objects, agents: ( ( objects == 0 ) & ( agents == 0 ) & ( getRandomArray(world,objects.shape) < 0.01 ), treeId ) )
+# world is a World without maps (only width, height and tick, cf. getStencilWorld()). Rules draw random values with getRandomArray(), which gives each cell the same values whichever part of the world it is stepped with.
+# With worker processes (cf. nbWorkers), rules are applied to strips of the world with one row of neighbours above and below: rules must only look at direct neighbours,
+# and rules must be registered before the workers are started (ie. before the first step). With "chunked" storage, rules are applied to chunks in the same way (cf. World.getStencilChangesByChunk()), and give the same results:
+# chunks without objects or agents around are skipped, unless rules change such empty areas (e.g. the example above, cf. changesEmptyCells()), in which case all chunks are visited (and chunked maps are not faster than others).
+stencilRules = [ burnRule ]
+
+def getStencilWorld(shape,tick,seed,rows,columns):
+    # world given to stencil rules, for a part of the world (the whole world, a strip or a chunk): no maps. rows and columns are arrays of the coordinates, in the world, of the rows and columns of the maps given to rules (cf. getRandomArray()).
+    world = World.__new__(World)
+    (world.height, world.width) = shape
+    world.tick = tick
+    world.seed = seed # seed of the step (same for all parts)
+    world.rows = rows
+    world.columns = columns
+    world.draws = 0 # number of calls to getRandomArray() so far
+    world.randomValue = None # if set, getRandomArray() returns this value for all cells (cf. changesEmptyCells())
+    return world
+
+def changesEmptyCells(shape,tick,seed,size):
+    # True if stencilRules change cells whose neighbourhood is empty (all 0), e.g. trees growing on empty cells. Rules are applied to an empty block of size x size cells (with its neighbours),
+    # with the random values of the step, then with all random values 0 and close to 1 (cf. getRandomArray()), so that rules changing empty cells with a small probability are caught too.
+    empty = np.zeros( ( size + 2, size + 2 ), dtype=np.int16 )
+    for value in ( None, 0.0, np.nextafter(1.0,0.0) ):
+        world = getStencilWorld( shape, tick, seed, np.arange( size + 2 ) % shape[0], np.arange( size + 2 ) % shape[1] )
+        world.randomValue = value
+        if len( getStencilChanges( world, empty, empty.astype(np.int32) )[0] ) > 0:
+            return True
+    return False
+
+def getStencilChanges(world,objects,agents):
+    # apply stencilRules to maps objects and agents (arrays indexed by [y,x]). Returns changed cells, column by column: arrays of x, y and new object.
+    newObjects = objects.copy()
+    for rule in stencilRules:
+        (mask, value) = rule(world,objects,agents)
+        newObjects[mask] = value if np.isscalar(value) else value[mask]
+    (xs, ys) = np.nonzero( ( newObjects != objects ).T )
+    return xs, ys, newObjects[ys,xs]
+
+def mergeStencilChanges(changes):
+    # changes of parts of the world (list of arrays of x, y and new object, cf. getStencilChanges()), as changes of the whole world, column by column
+    if len(changes) == 0:
+        return np.zeros( 0, np.int64 ), np.zeros( 0, np.int64 ), np.zeros( 0, np.int16 )
+    xs = np.concatenate( [ c[0] for c in changes ] )
+    ys = np.concatenate( [ c[1] for c in changes ] )
+    values = np.concatenate( [ c[2] for c in changes ] )
+    order = np.lexsort( (ys, xs) )
+    return xs[order], ys[order], values[order]
+
+workerPool = None # worker processes of the "stencil" fire engine (cf. nbWorkers), started when first needed
+attachedBlocks = {} # worker processes: name => shared memory block of a world map
+
+def initWorker():
+    signal.signal( signal.SIGTERM, signal.SIG_DFL ) # SDL (or stopHeadless) handles SIGTERM in the main process: workers must stop when the pool is terminated
+    signal.signal( signal.SIGINT, signal.SIG_DFL ) # (and must not run stopHeadless on their forked copy of the journal)
+    return
+
+def getWorkerPool():
+    global workerPool
+    if workerPool == None:
+        workerPool = multiprocessing.get_context("fork").Pool( nbWorkers, initWorker )
+    return workerPool
+
+def getSharedArray(name,shape,dtype):
+    block = attachedBlocks.get(name)
+    if block == None:
+        block = attachedBlocks[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray( shape, dtype=dtype, buffer=block.buf )
+
+def stepStencilStrip(task):
+    # worker process: apply stencilRules to rows y0 to y1-1 of the world. Maps are read from shared memory, with one row of neighbours (halo) above and below the strip, wrapping around the world. Returns changed cells (cf. getStencilChanges()).
+    (objectsName, agentsName, shape, y0, y1, seed, tick) = task
+    for name in list(attachedBlocks): # blocks of other maps (e.g. of a dropped world) are not used anymore
+        if name != objectsName and name != agentsName:
+            attachedBlocks.pop(name).close()
+    objects = getSharedArray( objectsName, shape, np.int16 )
+    agents = getSharedArray( agentsName, shape, np.int32 )
+    rows = np.arange( y0 - 1, y1 + 1 ) % shape[0]
+    (xs, ys, values) = getStencilChanges( getStencilWorld( shape, tick, seed, rows, np.arange(shape[1]) ), objects[rows], agents[rows] )
+    inside = ( ys >= 1 ) & ( ys <= y1 - y0 ) # drop halo rows
+    return xs[inside], ys[inside] - 1 + y0, values[inside]
+
+class Journal:
+    # append-only log of all cell changes of a world: one record per change (tick, x, y, layer, previous value, new value), written to a buffered file.
+    # layer is 0 (terrain), 1 (height), 2 (agent) or 3 + level (objects). Coordinates must be below 65536, values must fit in 16 bits.
+    # Snapshots of the world (cf. World.saveWorld()) are saved next to the journal, when it starts and every snapshotPeriod ticks (0: never), named <filename>_<tick>.npz.
+    # An existing journal is continued from tick <tick>: its records and snapshots from this tick on are dropped (e.g. the end of a run that is resumed from a saved world).
+
+    recordFormat = struct.Struct("<IHHBhh")
+    recordType = np.dtype( [ ("tick","<u4"), ("x","<u2"), ("y","<u2"), ("layer","u1"), ("previous","<i2"), ("new","<i2") ] ) # same as recordFormat, to read records with NumPy
+
+    def __init__(self,filename,snapshotPeriod=journalSnapshotPeriod,tick=0):
+        self.filename = filename
+        self.snapshotPeriod = snapshotPeriod
+        size = 0
+        if os.path.exists(filename):
+            size = os.path.getsize(filename) // self.recordFormat.size * self.recordFormat.size # (a record may have been partly written)
+            if size > 0:
+                records = np.memmap( filename, dtype=self.recordType, mode="r", shape=size // self.recordFormat.size )
+                size = int( np.searchsorted( records["tick"], tick ) ) * self.recordFormat.size
+                del records
+            for snapshotTick in getSnapshotTicks(filename):
+                if snapshotTick >= tick:
+                    removeWorldFile( self.getSnapshotFilename(snapshotTick) )
+        self.file = open( filename, "r+b" if os.path.exists(filename) else "wb", buffering=journalBufferSize )
+        self.file.truncate(size)
+        self.file.seek(size)
+        return
+
+    def record(self,tick,x,y,layer,previousValue,newValue):
+        self.file.write( self.recordFormat.pack( tick, x, y, layer, previousValue, newValue ) )
+        return
+
+    def getSnapshotFilename(self,tick):
+        return self.filename + "_" + str(tick) + ".npz"
+
+    def close(self):
+        self.file.close()
+        return
+
+def getSnapshotTicks(filename): # ticks of the snapshots of journal <filename>
+    prefix = os.path.basename(filename) + "_"
+    snapshotTicks = []
+    for name in os.listdir( os.path.dirname(filename) or "." ):
+        if name.startswith(prefix) and name.endswith(".npz") and name[len(prefix):-4].isdigit():
+            snapshotTicks.append( int( name[len(prefix):-4] ) )
+    return snapshotTicks
+
+def replayWorld(filename,tick):
+    # rebuild the world as it was at the beginning of simulation tick <tick>, from the nearest snapshot before it and journal <filename> (cf. Journal). Returns a new World.
+    # Maps are exact. Agents are rebuilt from the agent map (ie. agents sharing a cell are counted once), the random generator state is that of the snapshot: the replayed world is meant for analysis, not to resume the simulation.
+    snapshotTicks = [ t for t in getSnapshotTicks(filename) if t <= tick ]
+    if len(snapshotTicks) == 0:
+        print ("[ERROR] replayWorld(.) -- No snapshot of",filename,"before tick",tick)
+        return None
+
+    world = World()
+    startTick = world.loadWorld( filename + "_" + str(max(snapshotTicks)) + ".npz" )
+
+    # records are in chronological order: select ticks [startTick,tick[, then keep only the last change of each cell of each layer
+    records = np.memmap( filename, dtype=Journal.recordType, mode="r" ) if os.path.getsize(filename) > 0 else np.zeros( 0, dtype=Journal.recordType )
+    records = records[ np.searchsorted( records["tick"], startTick ) : np.searchsorted( records["tick"], tick ) ]
+    keys = ( records["layer"].astype(np.int64) * world.height + records["y"] ) * world.width + records["x"]
+    (keys, last) = np.unique( keys[::-1], return_index=True )
+    records = records[ len(records) - 1 - last ]
+
+    for (x,y,layer,value) in zip( records["x"].tolist(), records["y"].tolist(), records["layer"].tolist(), records["new"].tolist() ):
+        if layer == 0:
+            world.setTerrainAt(x,y,value)
+        elif layer == 1:
+            world.setHeightAt(x,y,value)
+        elif layer == 2:
+            world.setAgentAt(x,y,value)
+        else:
+            world.setObjectAt(x,y,value,layer-3)
+
+    world.agents[:] = [ BasicAgent( world.getAgentAt(x,y), world, (x,y) ) for (x,y) in findCells(world.agentMap) ]
+    world.tick = tick
+    return world
+
+class Scheduler:
+    # tasks run at given simulation ticks, in order of ticks (priority queue). A task is a function task(world,it), run once or every <period> ticks.
+    # Tasks due at the same tick run in order of registration. Tasks that are not due cost nothing.
+
+    def __init__(self):
+        self.queue = [] # heap of [ tick, order of registration, task, period, phase ]
+        self.tick = -1 # last tick run
+        self.count = 0 # number of tasks ever registered
+        return
+
+    def addTask(self,task,tick): # run task once, at tick
+        heapq.heappush( self.queue, [ tick, self.count, task, 0, 0 ] )
+        self.count += 1
+        return
+
+    def addRecurringTask(self,task,period,phase=0): # run task at every tick where tick % period == phase, from now on
+        heapq.heappush( self.queue, [ self.getNextTick(period,phase), self.count, task, period, phase ] )
+        self.count += 1
+        return
+
+    def getNextTick(self,period,phase): # first tick after the last one run where tick % period == phase
+        return self.tick + 1 + ( phase - ( self.tick + 1 ) ) % period
+
+    def run(self,world,it):
+        # run all tasks due at tick <it> (or before: tasks that were missed run once, late)
+        self.tick = it
+        while len(self.queue) > 0 and self.queue[0][0] <= it:
+            entry = heapq.heappop(self.queue)
+            entry[2](world,it)
+            if entry[3] > 0:
+                entry[0] = self.getNextTick( entry[3], entry[4] )
+                heapq.heappush( self.queue, entry )
+        return
+
+    def setTick(self,tick):
+        # set last tick run (e.g. after loading a world): recurring tasks will run from the next tick on
+        self.tick = tick
+        for entry in self.queue:
+            if entry[3] > 0:
+                entry[0] = self.getNextTick( entry[3], entry[4] )
+        heapq.heapify(self.queue)
+        return
+
+    def copy(self):
+        scheduler = Scheduler()
+        scheduler.queue = [ list(entry) for entry in self.queue ]
+        scheduler.tick = self.tick
+        scheduler.count = self.count
+        return scheduler
+
+class TimerWheel:
+    # events scheduled at a future tick, returned by advance() when that tick comes. Time is proportional to the number of events, not to their delays or to the number of pending events.
+    # Hierarchical wheel: 4 levels of 256 slots. Level L holds events due in the same block of 256^(L+1) ticks as the current tick, in slot (tick / 256^L) % 256. Slots of upper levels are moved to lower levels when their time comes.
+    # Delays must be less than 2^32 ticks.
+
+    levels = 4
+
+    def __init__(self,tick=0):
+        self.tick = tick # last processed tick
+        self.slots = [ {} for level in range(self.levels) ] # level => { slot index: events } (empty slots are not stored, so that empty wheels are cheap, e.g. for forks)
+        self.overdue = [] # events scheduled at a tick already processed: returned by the next call to advance()
+        self.size = 0 # number of pending events
+        self.size0 = 0 # number of events on level 0 (if none, ticks are skipped until the next slot of level 1)
+        return
+
+    def schedule(self,tick,event):
+        self.size += 1
+        if tick <= self.tick:
+            self.overdue.append( (tick,event) )
+        else:
+            self.insert(tick,event)
+        return
+
+    def insert(self,tick,event): # tick must not be processed yet (or be the tick being processed, when moving slots)
+        for level in range(self.levels):
+            if ( tick >> ( 8 * ( level + 1 ) ) ) == ( self.tick >> ( 8 * ( level + 1 ) ) ):
+                self.slots[level].setdefault( ( tick >> ( 8 * level ) ) & 255, [] ).append( (tick,event) )
+                if level == 0:
+                    self.size0 += 1
+                return
+        print ("[ERROR] TimerWheel.schedule(.) -- Cannot schedule event. Delay is too long.")
+        self.size -= 1
+        return
+
+    def advance(self,tick):
+        # process ticks up to <tick> (included). Returns due events as a list of (tick, event), in order of tick.
+        events = sorted( self.overdue, key=lambda entry: entry[0] ) # (events of the same tick stay in order of scheduling)
+        self.overdue = []
+        if self.size == len(events): # nothing else pending: no need to visit the slots
+            self.tick = max(self.tick,tick)
+        while self.tick < tick:
+            if self.size0 == 0: # skip empty ticks
+                self.tick = min( tick - 1, self.tick | 255 )
+            self.tick += 1
+            for level in range(self.levels-1,0,-1):
+                if self.tick & ( ( 1 << ( 8 * level ) ) - 1 ) == 0: # move slot to lower levels
+                    for (due,event) in self.slots[level].pop( ( self.tick >> ( 8 * level ) ) & 255, [] ):
+                        self.insert(due,event)
+            slot = self.slots[0].pop( self.tick & 255, None )
+            if slot != None:
+                self.size0 -= len(slot)
+                events.extend(slot)
+        self.size -= len(events)
+        return events
+
+class World:
+    # a world owns its maps, its agents and its random number generator, so that several independent worlds can live in the same process (e.g. ensembles of simulations).
+    # The displayed world is defaultWorld (cf. below): module-level get/set methods and step functions apply to it.
+
+    def __init__(self,width=worldWidth,height=worldHeight,levels=objectMapLevels,seed=None,storage=worldStorage):
+        self.width = width
+        self.height = height
+        self.levels = levels # number of object levels
+
+        # maps are NumPy arrays or ChunkedGrids (cf. makeGrid()), indexed by [y,x]. Use get/set methods to access cells.
+        self.terrainMap = makeGrid( (height, width), np.uint8, storage )
+        self.heightMap  = makeGrid( (height, width), np.int8, storage )
+        self.objectMap  = makeGrid( (height, width), np.int16, storage ) # objects on level 0. Negative values are invisible objects
+        self.agentMap   = makeGrid( (height, width), np.int32, storage )
+
+        # objects on upper levels are stored only for cells where objects are piled up
+        self.columnHeightMap = makeGrid( (height, width), np.uint8, storage ) # number of object levels used by each cell, ie. highest non-empty level + 1 (0: no object)
+        self.objectStacks = {} # (x,y) => [ object on level 1, object on level 2, ... ] up to the highest non-empty level (only for cells with a column height above 1). Lists are replaced, never modified (they may be shared by forks).
+        self.objectCells = {} # (type,level) => CellSet of cells (x,y) with this object on this level (cf. getCellsWith() and countObjects()), maintained by setObjectAt()
+        self.objectChanges = set() # cells where fire may spread from or to since the last fire step (cf. stepFireFrontier()): trees that caught fire, new trees next to burning trees
+        self.objectTimers = {} # (x,y) => tick when the object on level 0 will be replaced by the next one (cf. objectLifetimes)
+        self.timers = TimerWheel() # same, as events (x,y) of a timer wheel. Events that do not match objectTimers are obsolete (object changed in the meantime).
+
+        self.maxHeightValue = 0 # highest value ever written in heightMap (used by rendering to bound the search for cells overlapping on screen). Assume heights are non-negative.
+        self.maxObjectLevel = 1 # number of object levels ever used, ie. highest level ever written + 1 (same purpose). Agents are displayed as level 0 objects.
+
+        self.agents = []
+        self.random = Random(seed) # all random choices of the world and of its agents: same seed, same simulation
+
+        self.onCellChange = None # if set, called *before* a cell is modified: onCellChange(x,y,layer,previousValue,newValue), with layer in "terrain", "height", "object", "agent" (e.g. used for rendering)
+        self.journal = None # if set, all cell changes are recorded (cf. startJournal())
+        self.tick = 0 # current simulation tick (set by step(), stepWorld() and stepAgents(), used by the journal)
+
+        self.scheduler = Scheduler() # tasks of the simulation (cf. step()). Methods are looked up on the world a task is run for, so that subclasses may override them (and forks run their own).
+        self.scheduler.addRecurringTask( lambda world, it: world.stepTimers(it), 1 )
+        self.scheduler.addRecurringTask( lambda world, it: world.stepWorld(it), worldStepPeriod, worldStepPhase )
+        self.scheduler.addRecurringTask( lambda world, it: world.stepAgents(it), agentsStepPeriod, agentsStepPhase )
+        return
+
+    def getWidth(self):
+        return self.width
+
+    def getHeight(self):
+        return self.height
+
+    def getTerrainAt(self,x,y):
+        return self.terrainMap.item(y,x)
+
+    def setTerrainAt(self,x,y,type):
+        if self.onCellChange != None:
+            self.onCellChange(x,y,"terrain",self.terrainMap.item(y,x),type)
+        if self.journal != None:
+            self.journal.record(self.tick,x,y,0,self.terrainMap.item(y,x),type)
+        self.terrainMap[y,x] = type
+
+    def getHeightAt(self,x,y):
+        return self.heightMap.item(y,x)
+
+    def setHeightAt(self,x,y,height):
+        if self.onCellChange != None:
+            self.onCellChange(x,y,"height",self.heightMap.item(y,x),height)
+        if self.journal != None:
+            self.journal.record(self.tick,x,y,1,self.heightMap.item(y,x),height)
+        self.heightMap[y,x] = height
+        if height > self.maxHeightValue:
+            self.maxHeightValue = height
+
+    def getObjectAt(self,x,y,level=0):
+        if level == 0:
+            return self.objectMap.item(y,x)
+        elif level < self.levels:
+            if level < self.columnHeightMap.item(y,x):
+                return self.objectStacks[(x,y)][level-1]
+            return 0
+        else:
+            print ("[ERROR] getObjectMap(.) -- Cannot return object. Level does not exist.")
+            return 0
+
+    def setObjectAt(self,x,y,type,level=0): # negative values are possible: invisible but tangible objects (ie. no display, collision)
+        if level < self.levels:
+            previousType = self.getObjectAt(x,y,level)
+            if self.onCellChange != None:
+                self.onCellChange(x,y,"object",previousType,type)
+            if self.journal != None:
+                self.journal.record(self.tick,x,y,3+level,previousType,type)
+            if previousType != 0:
+                self.getObjectCells( (previousType,level) ).discard(x,y)
+            if type != 0:
+                self.getObjectCells( (type,level) ).add(x,y)
+            if level == 0:
+                if type == burningTreeId or ( type == treeId and self.isNextToFire(x,y) ): # (other changes cannot set trees on fire. A tree next to a tree that catches fire later is found from that tree.)
+                    self.objectChanges.add( (x,y) )
+                if type != previousType:
+                    if type in objectLifetimes:
+                        self.objectTimers[(x,y)] = self.tick + objectLifetimes[type][0]
+                        self.timers.schedule( self.objectTimers[(x,y)], (x,y) )
+                    elif (x,y) in self.objectTimers:
+                        del self.objectTimers[(x,y)]
+            if level == 0:
+                self.objectMap[y,x] = type
+            else:
+                stack = list( self.objectStacks.get( (x,y), [] ) )
+                if len(stack) < level:
+                    stack.extend( [0] * ( level - len(stack) ) )
+                stack[level-1] = type
+                while len(stack) > 0 and stack[-1] == 0: # forget empty upper levels
+                    stack.pop()
+                if len(stack) == 0:
+                    self.objectStacks.pop( (x,y), None )
+                else:
+                    self.objectStacks[(x,y)] = stack
+            if (x,y) in self.objectStacks:
+                self.columnHeightMap[y,x] = len( self.objectStacks[(x,y)] ) + 1
+            elif self.objectMap.item(y,x) != 0:
+                self.columnHeightMap[y,x] = 1
+            else:
+                self.columnHeightMap[y,x] = 0
+            if type != 0 and level >= self.maxObjectLevel:
+                self.maxObjectLevel = level + 1
+        else:
+            print ("[ERROR] setObjectMap(.) -- Cannot set object. Level does not exist.")
+            return 0
+
+    def getColumnHeight(self,x,y): # number of object levels used at (x,y), ie. highest non-empty level + 1 (0: no object). Levels above are empty.
+        return self.columnHeightMap.item(y,x)
+
+    def getAgentAt(self,x,y):
+        return self.agentMap.item(y,x)
+
+    def setAgentAt(self,x,y,type):
+        if self.onCellChange != None:
+            self.onCellChange(x,y,"agent",self.agentMap.item(y,x),type)
+        if self.journal != None:
+            self.journal.record(self.tick,x,y,2,self.agentMap.item(y,x),type)
+        self.agentMap[y,x] = type
+
+    def saveWorld(self,filename,it=0,compressed=compressWorldFiles):
+        # save everything about this world (maps, agents, random generator state) and simulation tick <it> to a NumPy .npz file
+        # memory-mapped maps are copied to files next to <filename> (<filename without extension>_<map name>.dat), referred to by the .npz file.
+        arrays = {}
+        arrays["size"] = np.array( [ self.width, self.height, self.levels ] )
+        arrays["tick"] = np.array(it)
+        arrays["maxValues"] = np.array( [ self.maxHeightValue, self.maxObjectLevel ] )
+        gridToArrays( self.terrainMap, "terrain", arrays, filename )
+        gridToArrays( self.heightMap, "height", arrays, filename )
+        gridToArrays( self.objectMap, "object", arrays, filename )
+        gridToArrays( self.agentMap, "agent", arrays, filename )
+        gridToArrays( self.columnHeightMap, "columnHeight", arrays, filename )
+        cells = list(self.objectStacks)
+        arrays["stackCells"] = np.array( cells, dtype=np.int64 ).reshape( len(cells), 2 )
+        arrays["stackLengths"] = np.array( [ len(self.objectStacks[cell]) for cell in cells ], dtype=np.int64 )
+        arrays["stackObjects"] = np.array( [ type for cell in cells for type in self.objectStacks[cell] ], dtype=np.int16 )
+        arrays["agents"] = np.array( [ ( a.getType(), a.x, a.y ) for a in self.agents ], dtype=np.int64 ).reshape( len(self.agents), 3 )
+        cells = list(self.objectTimers)
+        arrays["timerCells"] = np.array( cells, dtype=np.int64 ).reshape( len(cells), 2 )
+        arrays["timerTicks"] = np.array( [ self.objectTimers[cell] for cell in cells ], dtype=np.int64 )
+        (version, state, gauss) = self.random.getstate()
+        arrays["randomState"] = np.array( state, dtype=np.uint32 )
+        arrays["randomGauss"] = np.array( np.nan if gauss == None else gauss )
+        if compressed == True:
+            np.savez_compressed(filename,**arrays)
+        else:
+            np.savez(filename,**arrays)
+        return
+
+    def loadWorld(self,filename):
+        # replace everything about this world by the content of a file written by saveWorld(). Returns the simulation tick.
+        arrays = dict( np.load(filename) )
+        (self.width, self.height, self.levels) = arrays["size"].tolist()
+        (self.maxHeightValue, self.maxObjectLevel) = arrays["maxValues"].tolist()
+        shape = (self.height, self.width)
+        self.terrainMap = gridFromArrays( arrays, "terrain", shape, np.uint8 )
+        self.heightMap = gridFromArrays( arrays, "height", shape, np.int8 )
+        self.objectMap = gridFromArrays( arrays, "object", shape, np.int16 )
+        self.agentMap = gridFromArrays( arrays, "agent", shape, np.int32 )
+        self.columnHeightMap = gridFromArrays( arrays, "columnHeight", shape, np.uint8 )
+        stackObjects = np.split( arrays["stackObjects"], np.cumsum( arrays["stackLengths"] )[:-1] ) if len(arrays["stackLengths"]) > 0 else []
+        self.objectStacks = { (x,y): stack.tolist() for ((x,y), stack) in zip( arrays["stackCells"].tolist(), stackObjects ) }
+        self.indexObjects()
+        self.objectChanges = set( self.getCellsWith(burningTreeId) )
+        self.agents[:] = [ BasicAgent( type, self, (x,y) ) for (type,x,y) in arrays["agents"].tolist() ] # same list (may be referenced elsewhere)
+        gauss = arrays["randomGauss"].item()
+        self.random.setstate( ( 3, tuple( arrays["randomState"].tolist() ), None if math.isnan(gauss) else gauss ) )
+        self.tick = arrays["tick"].item()
+        self.objectTimers = {}
+        if "timerCells" in arrays: # (not in files saved by older versions)
+            self.objectTimers = { (x,y): tick for ((x,y), tick) in zip( arrays["timerCells"].tolist(), arrays["timerTicks"].tolist() ) }
+        self.resetTimers(self.tick) # the world was saved before tick self.tick was processed: objects due at this tick are overdue, ie. processed by the next step
+        self.scheduler.setTick( self.tick - 1 )
+        return self.tick
+
+    def resetTimers(self,tick):
+        # rebuild the timer wheel from objectTimers, with <tick> as last processed tick
+        self.timers = TimerWheel(tick)
+        for (cell, due) in self.objectTimers.items():
+            self.timers.schedule(due,cell)
+        return
+
+    def fork(self,seed=None):
+        # new world with the same state (maps, agents, random generator state -- or a new seed, to explore different futures), e.g. for what-if runs.
+        # With "chunked" storage, maps are shared until written (copy-on-write), so that forks are cheap: use it for many forks of a large world. Other maps are copied. Chunks of the object index (objectCells) are shared until written, too.
+        # Agents are shallow copies (same class and attributes, cf. copy.copy()), living in the fork: attributes holding mutable objects are shared with the original agents. The fork has no onCellChange callback and no journal.
+        world = type(self).__new__( type(self) ) # (same class: World subclasses keep their methods)
+        world.__dict__.update(self.__dict__)
+        world.terrainMap = forkGrid(self.terrainMap)
+        world.heightMap = forkGrid(self.heightMap)
+        world.objectMap = forkGrid(self.objectMap)
+        world.agentMap = forkGrid(self.agentMap)
+        world.columnHeightMap = forkGrid(self.columnHeightMap)
+        world.objectStacks = dict(self.objectStacks)
+        world.objectCells = { key: cells.fork() for (key, cells) in self.objectCells.items() }
+        world.objectChanges = set(self.objectChanges)
+        world.objectTimers = dict(self.objectTimers)
+        world.resetTimers(self.timers.tick)
+        world.scheduler = self.scheduler.copy()
+        world.agents = [ copy.copy(a) for a in self.agents ]
+        for a in world.agents:
+            a.world = world
+        world.random = Random()
+        if seed == None:
+            world.random.setstate( self.random.getstate() )
+        else:
+            world.random.seed(seed)
+        world.onCellChange = None
+        world.journal = None
+        return world
+
+    def startJournal(self,filename,snapshotPeriod=journalSnapshotPeriod):
+        # record all cell changes from now on (cf. Journal). The world is saved first, so that the journal can be replayed from the current tick.
+        self.stopJournal()
+        self.journal = Journal(filename,snapshotPeriod,self.tick)
+        self.saveWorld( self.journal.getSnapshotFilename(self.tick), self.tick )
+        return
+
+    def stopJournal(self):
+        if self.journal != None:
+            self.journal.close()
+            self.journal = None
+        return
+
+    def setTick(self,it):
+        # called at each simulation tick, before anything changes. Saves a snapshot of the world for the journal, if needed.
+        if it != self.tick:
+            self.tick = it
+            if self.journal != None and self.journal.snapshotPeriod > 0 and it % self.journal.snapshotPeriod == 0:
+                self.saveWorld( self.journal.getSnapshotFilename(it), it )
+        return
+
+    def getCellsWith(self,type,level=0):
+        # cells (x,y) with an object of this type on this level (a CellSet, iterated by column, then row: do not modify it). Time is proportional to the number of such objects, not to the world size.
+        return self.objectCells.get( (type,level), CellSet() )
+
+    def getObjectCells(self,key):
+        # CellSet objectCells[key], created if needed
+        cells = self.objectCells.get(key)
+        if cells == None:
+            cells = self.objectCells[key] = CellSet()
+        return cells
+
+    def countObjects(self,type,level=None): # number of objects of this type on this level (default: all levels)
+        if level == None:
+            return sum( len(cells) for ((t,l), cells) in self.objectCells.items() if t == type )
+        return len( self.getCellsWith(type,level) )
+
+    def indexObjects(self):
+        # rebuild objectCells from the maps (e.g. after loading), block by block: chunks of chunked maps, or blocks of rows of other maps (memory-mapped maps are never read as a whole)
+        self.objectCells = {}
+        if isinstance(self.objectMap,ChunkedGrid):
+            size = self.objectMap.chunkSize
+            blocks = ( ( xChunk * size, yChunk * size, chunk ) for ((xChunk,yChunk), chunk) in self.objectMap.chunks.items() )
+        else:
+            blocks = ( ( 0, y, np.asarray( self.objectMap[ y : y + storageChunkSize ] ) ) for y in range( 0, self.height, storageChunkSize ) )
+        for (x0, y0, block) in blocks:
+            for type in np.unique(block).tolist():
+                if type != 0:
+                    self.getObjectCells( (type,0) ).addCells( x0, y0, block == type )
+        for ((x,y), stack) in self.objectStacks.items():
+            for level in range(1,len(stack)+1):
+                if stack[level-1] != 0:
+                    self.getObjectCells( (stack[level-1],level) ).add(x,y)
+        return
+
+    ###
+
+    def initWorld(self):
+
+        # add a pyramid-shape building
+        building1TerrainMap = [
+        [ 2, 2, 2, 2 ],
+        [ 2, 3, 3, 2 ],
+        [ 2, 3, 3, 2 ],
+        [ 2, 2, 2, 2 ]
+        ]
+        building1HeightMap = [
+        [ 1, 1, 1, 1 ],
+        [ 1, 2, 2, 1 ],
+        [ 1, 2, 2, 1 ],
+        [ 1, 1, 1, 1 ]
+        ]
+        x_offset = 3
+        y_offset = 3
+        for x in range( len( building1TerrainMap[0] ) ):
+            for y in range( len( building1TerrainMap ) ):
+                self.setTerrainAt( x+x_offset, y+y_offset, building1TerrainMap[x][y] )
+                self.setHeightAt( x+x_offset, y+y_offset, building1HeightMap[x][y] )
+                self.setObjectAt( x+x_offset, y+y_offset, -1 ) # add a virtual object: not displayed, but used to forbid agent(s) to come here.
+
+        # add another pyramid-shape building with a tree on top
+        building2TerrainMap = [
+        [ 0, 2, 2, 2, 2, 2, 0 ],
+        [ 2, 2, 2, 2, 2, 2, 2 ],
+        [ 2, 2, 2, 2, 2, 2, 2 ],
+        [ 2, 2, 2, 2, 2, 2, 2 ],
+        [ 2, 2, 2, 2, 2, 2, 2 ],
+        [ 2, 2, 2, 2, 2, 2, 2 ],
+        [ 2, 2, 2, 2, 2, 2, 2 ],
+        [ 2, 2, 2, 2, 2, 2, 2 ],
+        [ 0, 2, 2, 2, 2, 2, 0 ]
+        ]
+        building2HeightMap = [
+        [ 0, 1, 1, 1, 1, 1, 0 ],
+        [ 1, 1, 1, 1, 1, 1, 1 ],
+        [ 1, 2, 2, 2, 2, 2, 1 ],
+        [ 1, 2, 3, 3, 3, 2, 1 ],
+        [ 1, 2, 3, 4, 3, 2, 1 ],
+        [ 1, 2, 3, 3, 3, 2, 1 ],
+        [ 1, 2, 2, 2, 2, 2, 1 ],
+        [ 1, 1, 1, 1, 1, 1, 1 ],
+        [ 0, 1, 1, 1, 1, 1, 0 ]
+        ]
+        x_offset = 4
+        y_offset = 13
+        for x in range( len( building2TerrainMap[0] ) ):
+            for y in range( len( building2TerrainMap ) ):
+                self.setTerrainAt( x+x_offset, y+y_offset, building2TerrainMap[y][x] )
+                self.setHeightAt( x+x_offset, y+y_offset, building2HeightMap[y][x] )
+                self.setObjectAt( x+x_offset, y+y_offset, -1 ) # add a virtual object: not displayed, but used to forbid agent(s) to come here.
+        self.setObjectAt( x_offset+3, y_offset+4, treeId )
+
+        for c in [(20,2),(30,2),(30,12),(20,12)]:
+            for level in range(0,self.levels):
+                self.setObjectAt(c[0],c[1],blockId,level)
+        for i in range(9):
+            self.setObjectAt(21+i,2,blockId,self.levels-1)
+            self.setObjectAt(21+i,12,blockId,self.levels-1)
+            self.setObjectAt(20,3+i,blockId,self.levels-1)
+            self.setObjectAt(30,3+i,blockId,self.levels-1)
+
+        for i in range(nbAgents):
+            self.agents.append(BasicAgent(ghostId,self))
+
+        for i in range(nbTrees):
+            x = self.random.randint(0,self.width-1)
+            y = self.random.randint(0,self.height-1)
+            while self.getTerrainAt(x,y) != 0 or self.getObjectAt(x,y) != 0:
+                x = self.random.randint(0,self.width-1)
+                y = self.random.randint(0,self.height-1)
+            self.setObjectAt(x,y,treeId)
+
+        for i in range(nbBurningTrees):
+            x = self.random.randint(0,self.width-1)
+            y = self.random.randint(0,self.height-1)
+            while self.getTerrainAt(x,y) != 0 or self.getObjectAt(x,y) != 0:
+                x = self.random.randint(0,self.width-1)
+                y = self.random.randint(0,self.height-1)
+            self.setObjectAt(x,y,burningTreeId)
+
+        return
+
+    ###
+
+    def step( self, it ): # run all tasks due at simulation tick <it> (cf. Scheduler)
+        self.setTick(it)
+        self.scheduler.run(self,it)
+        return
+
+    def stepTimers( self, it = 0 ): # it is the simulation tick
+        # objects reaching the end of their lifetime (cf. objectLifetimes)
+        self.setTick(it)
+        for (tick, (x,y)) in self.timers.advance(it):
+            if self.objectTimers.get( (x,y) ) == tick:
+                del self.objectTimers[(x,y)]
+                if self.getObjectAt(x,y) in objectLifetimes:
+                    self.setObjectAt( x, y, objectLifetimes[ self.getObjectAt(x,y) ][1] )
+        return
+
+    def stepWorld( self, it = 0 ): # it is the simulation tick
+        # fire propagation (cf. fireEngine)
+        self.setTick(it)
+        changes = self.objectChanges
+        self.objectChanges = set()
+        if fireEngine == "scan":
+            if isinstance(self.objectMap,np.ndarray) and isinstance(self.agentMap,np.ndarray) and type(self).burnTree is World.burnTree and type(self).stepFireScan is World.stepFireScan and kernelsEnabled() == True: # (cheap checks first: kernels are compiled and checked on first use. burnKernel only reproduces World's own fire rule)
+                self.stepFireKernel()
+            else:
+                self.stepFireScan()
+        elif fireEngine == "stencil":
+            self.stepStencil()
+        else:
+            self.stepFireFrontier(changes)
+        return
+
+    def isNextToFire(self,x,y): # True if a neighbour is a burning tree
+        for neighbours in ((-1,0),(+1,0),(0,-1),(0,+1)):
+            if self.getObjectAt((x+neighbours[0]+self.width)%self.width,(y+neighbours[1]+self.height)%self.height) == burningTreeId:
+                return True
+        return False
+
+    def burnTree(self,x,y):
+        # a tree catches fire if a neighbour is burning or is a ghost. Returns True if it does.
+        width = self.width
+        height = self.height
+        burning = False
+        for neighbours in ((-1,0),(+1,0),(0,-1),(0,+1)):
+            if self.getObjectAt((x+neighbours[0]+width)%width,(y+neighbours[1]+height)%height) == burningTreeId:
+                self.setObjectAt(x,y,burningTreeId)
+                burning = True
+            elif self.getAgentAt((x+neighbours[0]+width)%width,(y+neighbours[1]+height)%height) == ghostId:
+                self.setObjectAt(x,y,burningTreeId)
+                burning = True
+        return burning
+
+    def stepFireScan(self):
+        # visit all trees, column by column: trees may catch fire from trees set on fire before them
+        for (x,y) in self.getCellsWith(treeId).getCells():
+            self.burnTree(x,y)
+        return
+
+    def stepFireKernel(self):
+        # same as stepFireScan(), with burnKernel(). Maps must be NumPy arrays (possibly memory-mapped: they are read and written in place, never copied).
+        (xs, ys) = self.getCellsWith(treeId).getCellArrays()
+        objects = np.asarray(self.objectMap)
+        changes = np.zeros( ( len(xs), 2 ), dtype=np.int64 )
+        n = burnKernel( xs, ys, objects, np.asarray(self.agentMap), treeId, burningTreeId, ghostId, changes )
+        objects[ changes[:n,1], changes[:n,0] ] = treeId # back to trees: trees are set on fire below with setObjectAt(), which maintains the index, the journal, etc.
+        for (x,y) in changes[:n].tolist():
+            self.setObjectAt(x,y,burningTreeId)
+        return
+
+    def moveAgentsKernel(self):
+        # same as shuffling and moving all agents (cf. stepAgents()), with moveAgentsKernel(). Maps must be NumPy arrays. The agent map is written directly (no onCellChange, no journal).
+        (version, state, gauss) = self.random.getstate()
+        state = np.array( state, dtype=np.int64 )
+        xs = np.fromiter( ( a.x for a in self.agents ), dtype=np.int64, count=len(self.agents) )
+        ys = np.fromiter( ( a.y for a in self.agents ), dtype=np.int64, count=len(self.agents) )
+        types = np.fromiter( ( a.type for a in self.agents ), dtype=np.int64, count=len(self.agents) )
+        order = moveAgentsKernel( state, xs, ys, types, np.asarray(self.objectMap), np.asarray(self.agentMap) )
+        for (a, x, y) in zip( self.agents, xs.tolist(), ys.tolist() ):
+            a.x = x
+            a.y = y
+        self.agents[:] = [ self.agents[i] for i in order.tolist() ]
+        self.random.setstate( ( version, tuple( state.tolist() ), gauss ) )
+        return
+
+    def stepStencil(self):
+        # apply all stencilRules to the whole world at once (synchronous update). Changes are written with setObjectAt(), column by column.
+        # With worker processes (cf. nbWorkers) and maps in shared memory, the world is split into horizontal strips, each one stepped by a worker. With chunked maps, rules are applied chunk by chunk.
+        # Random values of rules depend on the seed of the step (a single draw of the world's generator) and on the coordinates of cells in the world, not on the strip or chunk they are stepped with (cf. getRandomArray()): results do not depend on the number of workers or on the storage of maps.
+        seed = self.random.getrandbits(64)
+        objectsBlock = getSharedBlock(self.objectMap)
+        agentsBlock = getSharedBlock(self.agentMap)
+        if nbWorkers > 0 and objectsBlock != None and agentsBlock != None:
+            bounds = sorted( set( np.linspace( 0, self.height, nbWorkers + 1 ).astype(int).tolist() ) )
+            tasks = [ ( objectsBlock.name, agentsBlock.name, (self.height,self.width), y0, y1, seed, self.tick ) for (y0, y1) in zip( bounds[:-1], bounds[1:] ) ]
+            (xs, ys, values) = mergeStencilChanges( getWorkerPool().map( stepStencilStrip, tasks ) )
+        elif isinstance(self.objectMap,ChunkedGrid) and isinstance(self.agentMap,ChunkedGrid):
+            (xs, ys, values) = self.getStencilChangesByChunk(seed)
+        else:
+            (xs, ys, values) = getStencilChanges( getStencilWorld( (self.height, self.width), self.tick, seed, np.arange(self.height), np.arange(self.width) ), np.asarray(self.objectMap), np.asarray(self.agentMap) )
+        for (x,y,type) in zip( xs.tolist(), ys.tolist(), values.tolist() ):
+            self.setObjectAt(x,y,type)
+        return
+
+    def getStencilChangesByChunk(self,seed):
+        # same as getStencilChanges() for chunked maps, which are never allocated as a whole: rules are applied chunk by chunk, each chunk with one cell of neighbours around (as strips of workers, cf. stepStencilStrip()).
+        # Only chunks where objects or agents were written, and their neighbours, are visited: elsewhere, cells and their neighbours are all 0. If rules change such empty areas (cf. changesEmptyCells()), all chunks are visited, as with other maps.
+        size = self.objectMap.chunkSize
+        nbColumns = ( self.width + size - 1 ) // size
+        nbRows = ( self.height + size - 1 ) // size
+        if changesEmptyCells( (self.height, self.width), self.tick, seed, size ):
+            keys = { (xChunk,yChunk) for xChunk in range(nbColumns) for yChunk in range(nbRows) }
+        else:
+            keys = set(self.objectMap.chunks) | { ( x // size, y // size ) for (x,y) in findCells(self.agentMap) }
+            keys = { ( ( xChunk + dx ) % nbColumns, ( yChunk + dy ) % nbRows ) for (xChunk,yChunk) in keys for dx in (-1,0,1) for dy in (-1,0,1) }
+        changes = []
+        for (xChunk,yChunk) in sorted(keys):
+            (x0, y0) = ( xChunk * size, yChunk * size )
+            (x1, y1) = ( min( x0 + size, self.width ), min( y0 + size, self.height ) )
+            rows = np.arange( y0 - 1, y1 + 1 ) % self.height
+            columns = np.arange( x0 - 1, x1 + 1 ) % self.width
+            (xs, ys, values) = getStencilChanges( getStencilWorld( (self.height, self.width), self.tick, seed, rows, columns ), self.objectMap.getCells(rows,columns), self.agentMap.getCells(rows,columns) )
+            inside = ( xs >= 1 ) & ( xs <= x1 - x0 ) & ( ys >= 1 ) & ( ys <= y1 - y0 ) # drop neighbours
+            changes.append( ( xs[inside] - 1 + x0, ys[inside] - 1 + y0, values[inside] ) )
+        return mergeStencilChanges(changes)
+
+    def stepFireFrontier(self,changes):
+        # same as stepFireScan(), but only visits trees that may catch fire: trees next to ghosts (from agents' positions), and trees next to (or on) cells of <changes> (cf. objectChanges).
+        # Trees are visited in the same order; trees set on fire add their neighbours that come later in this order.
+        width = self.width
+        height = self.height
+        cells = set(changes)
+        for a in self.agents:
+            if a.getType() == ghostId:
+                cells.add( (a.x,a.y) )
+        candidates = set()
+        for (x,y) in cells:
+            candidates.add( (x,y) )
+            for neighbours in ((-1,0),(+1,0),(0,-1),(0,+1)):
+                candidates.add( ( (x+neighbours[0]+width)%width, (y+neighbours[1]+height)%height ) )
+        heap = [ (x,y) for (x,y) in candidates if self.getObjectAt(x,y) == treeId ]
+        heapq.heapify(heap)
+        visited = set()
+        while len(heap) > 0:
+            (x,y) = heapq.heappop(heap)
+            if (x,y) in visited:
+                continue
+            visited.add( (x,y) )
+            if self.burnTree(x,y) == True:
+                for neighbours in ((-1,0),(+1,0),(0,-1),(0,+1)):
+                    neighbour = ( (x+neighbours[0]+width)%width, (y+neighbours[1]+height)%height )
+                    if neighbour > (x,y) and self.getObjectAt(neighbour[0],neighbour[1]) == treeId:
+                        heapq.heappush(heap,neighbour)
+        return
+
+    def stepAgents( self, it = 0 ): # it is the simulation tick
+        self.setTick(it)
+        # move agent
+        if self.onCellChange == None and self.journal == None and verbose == False and isinstance(self.objectMap,np.ndarray) and isinstance(self.agentMap,np.ndarray) and all( type(a).move is BasicAgent.move for a in self.agents ) and kernelsEnabled() == True: # (cheap checks first: kernels are compiled and checked on first use. moveAgentsKernel only reproduces BasicAgent's random walk)
+            self.moveAgentsKernel()
+        else:
+            self.random.shuffle(self.agents)
+            for a in self.agents:   # shuffle agents in in-place (i.e. agents is modified)
+                a.move()
+        return
+
+defaultWorld = World() # the displayed world
+agents = defaultWorld.agents # agents of the default world
 
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
 ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ###
@@ -400,89 +2304,7 @@ agents = []
 ###
 
 def initWorld():
-    global nbTrees, nbBurningTrees, agents
-
-    # add a pyramid-shape building
-    building1TerrainMap = [
-    [ 2, 2, 2, 2 ],
-    [ 2, 3, 3, 2 ],
-    [ 2, 3, 3, 2 ],
-    [ 2, 2, 2, 2 ]
-    ]
-    building1HeightMap = [
-    [ 1, 1, 1, 1 ],
-    [ 1, 2, 2, 1 ],
-    [ 1, 2, 2, 1 ],
-    [ 1, 1, 1, 1 ]
-    ]
-    x_offset = 3
-    y_offset = 3
-    for x in range( len( building1TerrainMap[0] ) ):
-        for y in range( len( building1TerrainMap ) ):
-            setTerrainAt( x+x_offset, y+y_offset, building1TerrainMap[x][y] )
-            setHeightAt( x+x_offset, y+y_offset, building1HeightMap[x][y] )
-            setObjectAt( x+x_offset, y+y_offset, -1 ) # add a virtual object: not displayed, but used to forbid agent(s) to come here.
-
-    # add another pyramid-shape building with a tree on top
-    building2TerrainMap = [
-    [ 0, 2, 2, 2, 2, 2, 0 ],
-    [ 2, 2, 2, 2, 2, 2, 2 ],
-    [ 2, 2, 2, 2, 2, 2, 2 ],
-    [ 2, 2, 2, 2, 2, 2, 2 ],
-    [ 2, 2, 2, 2, 2, 2, 2 ],
-    [ 2, 2, 2, 2, 2, 2, 2 ],
-    [ 2, 2, 2, 2, 2, 2, 2 ],
-    [ 2, 2, 2, 2, 2, 2, 2 ],
-    [ 0, 2, 2, 2, 2, 2, 0 ]
-    ]
-    building2HeightMap = [
-    [ 0, 1, 1, 1, 1, 1, 0 ],
-    [ 1, 1, 1, 1, 1, 1, 1 ],
-    [ 1, 2, 2, 2, 2, 2, 1 ],
-    [ 1, 2, 3, 3, 3, 2, 1 ],
-    [ 1, 2, 3, 4, 3, 2, 1 ],
-    [ 1, 2, 3, 3, 3, 2, 1 ],
-    [ 1, 2, 2, 2, 2, 2, 1 ],
-    [ 1, 1, 1, 1, 1, 1, 1 ],
-    [ 0, 1, 1, 1, 1, 1, 0 ]
-    ]
-    x_offset = 4
-    y_offset = 13
-    for x in range( len( building2TerrainMap[0] ) ):
-        for y in range( len( building2TerrainMap ) ):
-            setTerrainAt( x+x_offset, y+y_offset, building2TerrainMap[y][x] )
-            setHeightAt( x+x_offset, y+y_offset, building2HeightMap[y][x] )
-            setObjectAt( x+x_offset, y+y_offset, -1 ) # add a virtual object: not displayed, but used to forbid agent(s) to come here.
-    setObjectAt( x_offset+3, y_offset+4, treeId )
-
-    for c in [(20,2),(30,2),(30,12),(20,12)]:
-        for level in range(0,objectMapLevels):
-            setObjectAt(c[0],c[1],blockId,level)
-    for i in range(9):
-        setObjectAt(21+i,2,blockId,objectMapLevels-1)
-        setObjectAt(21+i,12,blockId,objectMapLevels-1)
-        setObjectAt(20,3+i,blockId,objectMapLevels-1)
-        setObjectAt(30,3+i,blockId,objectMapLevels-1)
-
-    for i in range(nbAgents):
-        agents.append(BasicAgent(ghostId))
-
-    for i in range(nbTrees):
-        x = randint(0,getWorldWidth()-1)
-        y = randint(0,getWorldHeight()-1)
-        while getTerrainAt(x,y) != 0 or getObjectAt(x,y) != 0:
-            x = randint(0,getWorldWidth()-1)
-            y = randint(0,getWorldHeight()-1)
-        setObjectAt(x,y,treeId)
-
-    for i in range(nbBurningTrees):
-        x = randint(0,getWorldWidth()-1)
-        y = randint(0,getWorldHeight()-1)
-        while getTerrainAt(x,y) != 0 or getObjectAt(x,y) != 0:
-            x = randint(0,getWorldWidth()-1)
-            y = randint(0,getWorldHeight()-1)
-        setObjectAt(x,y,burningTreeId)
-
+    defaultWorld.initWorld()
     return
 
 ### ### ### ### ###
@@ -492,26 +2314,35 @@ def initAgents():
 
 ### ### ### ### ###
 
-def stepWorld( it = 0 ):
-    if it % (maxFps/10) == 0:
-        for x in range(worldWidth):
-            for y in range(worldHeight):
-                if getObjectAt(x,y) == treeId:
-                    for neighbours in ((-1,0),(+1,0),(0,-1),(0,+1)):
-                        if getObjectAt((x+neighbours[0]+worldWidth)%worldWidth,(y+neighbours[1]+worldHeight)%worldHeight) == burningTreeId:
-                            setObjectAt(x,y,burningTreeId)
-                        elif getAgentAt((x+neighbours[0]+worldWidth)%worldWidth,(y+neighbours[1]+worldHeight)%worldHeight) == ghostId:
-                            setObjectAt(x,y,burningTreeId)
+def stepSimulation( it ): # run all tasks of the default world due at simulation tick <it> (cf. World.step())
+    defaultWorld.step(it)
     return
 
 ### ### ### ### ###
 
-def stepAgents( it = 0 ):
-    # move agent
-    if it % (maxFps/10) == 0:
-        shuffle(agents)
-        for a in agents:   # shuffle agents in in-place (i.e. agents is modified)
-            a.move()
+def stepWorld( it = 0 ): # it is the simulation tick
+    defaultWorld.stepWorld(it)
+    return
+
+### ### ### ### ###
+
+def saveWorld( filename = worldFilename, it = 0 ): # save the default world, at simulation tick <it>
+    defaultWorld.saveWorld(filename,it)
+    return
+
+def loadWorld( filename = worldFilename ): # load the default world (the whole screen will be redrawn). Returns the simulation tick.
+    it = defaultWorld.loadWorld(filename)
+    resetRendering()
+    return it
+
+### ### ### ### ###
+
+def stepAgents( it = 0 ): # it is the simulation tick
+    defaultWorld.stepAgents(it)
+    return
+
+def spawnGhost( world, it ): # task of the default world (cf. Scheduler): a new ghost appears
+    world.agents.append(BasicAgent(ghostId,world))
     return
 
 
@@ -522,66 +2353,140 @@ def stepAgents( it = 0 ):
 ###
 ###
 
+if headless == False:
+    defaultWorld.onCellChange = cellWillChange
+
 timestamp = datetime.datetime.now().timestamp()
 
-loadAllImages()
+if headless == False:
+    loadAllImages()
+    prescaleAllImages()
 
 displayWelcomeMessage()
 
-initWorld()
-initAgents()
+if "--check-kernels" in sys.argv:
+    if numba == None:
+        print ("Numba is not installed: kernels are not compiled (and not used).")
+    print ("Kernels give the same results as the Python code:",checkKernels())
+    pygame.quit()
+    sys.exit()
+
+startIt = 0
+if "--load" in sys.argv:
+    startIt = loadWorld(worldFilename)
+    print ("World loaded from",worldFilename,"at iteration",startIt)
+else:
+    initWorld()
+    initAgents()
+
+if journalFilename != None:
+    defaultWorld.startJournal(journalFilename)
+
+defaultWorld.scheduler.addRecurringTask( spawnGhost, spawnPeriod, spawnPhase )
+
+if headless == True: # simulation only: no player, no event loop, no frame rate limit
+
+    def stopHeadless(signum,frame):
+        # SDL turns SIGTERM/SIGINT into QUIT events, which nobody reads in headless mode: stop here instead (flushes the journal)
+        print ("[Quit] ( signal",signum,"at iteration",it,")")
+        defaultWorld.stopJournal()
+        pygame.quit()
+        sys.exit()
+        return
+
+    it = startIt
+    signal.signal( signal.SIGTERM, stopHeadless )
+    signal.signal( signal.SIGINT, stopHeadless )
+
+    print ("initWorld:",datetime.datetime.now().timestamp()-timestamp,"second(s)")
+    timeStampStart = timeStamp = datetime.datetime.now().timestamp()
+
+    for it in range(startIt,nbIterations):
+
+        if it != 0 and it % 10000 == 0 and verboseFps:
+            print ("[ips] ", 10000 / ( datetime.datetime.now().timestamp()-timeStamp ) ) # iterations per second
+            timeStamp = datetime.datetime.now().timestamp()
+
+        if snapshotPeriod > 0 and it % snapshotPeriod == 0:
+            saveSnapshot("snapshot_"+str(it)+".png",it)
+
+        if savePeriod > 0 and it != startIt and it % savePeriod == 0:
+            saveWorld(worldFilename,it)
+
+        stepSimulation(it)
+
+    print ("[Quit] (", ( nbIterations - startIt ) / ( datetime.datetime.now().timestamp()-timeStampStart ),"iterations per second )")
+
+    defaultWorld.stopJournal()
+    pygame.quit()
+    sys.exit()
 
 player = BasicAgent(invaderId)
 
 print ("initWorld:",datetime.datetime.now().timestamp()-timestamp,"second(s)")
 timeStampStart = timeStamp = datetime.datetime.now().timestamp()
 
-it = itStamp = 0
+it = itStamp = startIt # simulation tick
+frame = frameStamp = 0 # rendered frame
+
+tickDuration = 1 / ticksPerSecond # in seconds
+lag = 0 # simulation time (in seconds, at current speed) not simulated yet
+lastTime = time.perf_counter()
 
 userExit = False
 
 while userExit == False:
 
-    if it != 0 and it % 100 == 0 and verboseFps:
-        print ("[fps] ", ( it - itStamp ) / ( datetime.datetime.now().timestamp()-timeStamp ) )
+    if frame != 0 and frame % 100 == 0 and verboseFps:
+        print ("[fps] ", ( frame - frameStamp ) / ( datetime.datetime.now().timestamp()-timeStamp ), "[ticks per second] ", ( it - itStamp ) / ( datetime.datetime.now().timestamp()-timeStamp ), "[trees] ", countObjects(treeId), "[burning trees] ", countObjects(burningTreeId) )
         timeStamp = datetime.datetime.now().timestamp()
+        frameStamp = frame
         itStamp = it
 
     #screen.blit(pygame.font.render(str(currentFps), True, (255,255,255)), (screenWidth-100, screenHeight-50))
 
-    render(it)
-
-    stepWorld(it)
-
-    perdu = False
-    for a in agents:
-        if a.getPosition() == player.getPosition():
-            perdu = True
-            break
+    updatedRects = render(it)
+
+    # simulation: run as many ticks as needed to catch up with real time (at current speed). If rendering falls behind, several ticks are run per frame (ie. frames are dropped).
+    now = time.perf_counter()
+    lag = lag + ( now - lastTime ) * simulationSpeed
+    lastTime = now
+    while lag >= tickDuration:
+
+        perdu = False
+        for a in agents:
+            if a.getPosition() == player.getPosition():
+                perdu = True
+                break
+
+        stepSimulation(it)
+
+        for a in agents:
+            if a.getPosition() == player.getPosition():
+                perdu = True
+                break
+
+        if perdu == True:
+            print ("")
+            print ("#### #### #### #### ####")
+            print ("####                ####")
+            print ("####     PERDU !    ####")
+            print ("####                ####")
+            print ("#### #### #### #### ####")
+            print ("")
+            print (">>> Score:",it,"--> BRAVO! ")
+            print ("")
+            defaultWorld.stopJournal()
+            pygame.quit()
+            sys.exit()
 
-    stepAgents(it)
+        it += 1
+        lag = lag - tickDuration
 
-    for a in agents:
-        if a.getPosition() == player.getPosition():
-            perdu = True
+        if time.perf_counter() - now > 1 / minFps: # cannot keep up: slow down simulation rather than rendering
+            lag = 0
             break
 
-    if perdu == True:
-        print ("")
-        print ("#### #### #### #### ####")
-        print ("####                ####")
-        print ("####     PERDU !    ####")
-        print ("####                ####")
-        print ("#### #### #### #### ####")
-        print ("")
-        print (">>> Score:",it,"--> BRAVO! ")
-        print ("")
-        pygame.quit()
-        sys.exit()
-
-    if it % 10 == 0:
-        agents.append(BasicAgent(ghostId))
-
     # continuous stroke
     keys = pygame.key.get_pressed()
     if keys[pygame.K_LEFT] and not ( keys[pygame.K_LSHIFT] or keys[pygame.K_RSHIFT] ):
@@ -604,6 +2509,7 @@ while userExit == False:
     # single stroke
     for event in pygame.event.get():
         if event.type == QUIT:
+            defaultWorld.stopJournal()
             pygame.quit()
             sys.exit()
         if event.type == KEYUP:
@@ -650,35 +2556,48 @@ while userExit == False:
                 if verbose:
                     print ("View surface is (",viewWidth,",",viewHeight,")")
             elif event.key == pygame.K_o and pygame.key.get_mods() & pygame.KMOD_SHIFT:
-                if viewWidth < worldWidth :
+                if viewWidth < getWorldWidth() :
                     viewWidth = viewWidth * 2
                     viewHeight = viewHeight * 2
                 if verbose:
                     print ("View surface is (",viewWidth,",",viewHeight,")")
             elif event.key == pygame.K_s and not( pygame.key.get_mods() & pygame.KMOD_SHIFT ) :
-                if scaleMultiplier > 0.125:
+                if scaleMultiplier > zoomSteps[0]:
                     scaleMultiplier = scaleMultiplier / 2
-                if scaleMultiplier < 0.125:
-                    scaleMultiplier = 0.125
+                if scaleMultiplier < zoomSteps[0]:
+                    scaleMultiplier = zoomSteps[0]
                 resetImages()
                 if verbose:
                     print ("scaleMultiplier is ",scaleMultiplier)
+            elif event.key in (pygame.K_1, pygame.K_2, pygame.K_3, pygame.K_4):
+                simulationSpeed = speedSteps[ [pygame.K_1, pygame.K_2, pygame.K_3, pygame.K_4].index(event.key) ]
+                print ("simulation speed is x",simulationSpeed)
+            elif event.key == pygame.K_p:
+                if simulationSpeed == 0:
+                    simulationSpeed = speedSteps[0]
+                else:
+                    simulationSpeed = 0
+                print ("simulation speed is x",simulationSpeed)
             elif event.key == pygame.K_s and pygame.key.get_mods() & pygame.KMOD_SHIFT:
-                if scaleMultiplier < 1.0:
+                if scaleMultiplier < zoomSteps[-1]:
                     scaleMultiplier = scaleMultiplier * 2
-                if scaleMultiplier > 1.0:
-                    scaleMultiplier = 1.0
+                if scaleMultiplier > zoomSteps[-1]:
+                    scaleMultiplier = zoomSteps[-1]
                 resetImages()
                 if verbose:
                     print ("scaleMultiplier is ",scaleMultiplier)
 
-    pygame.display.flip()
+    if updatedRects == None:
+        pygame.display.flip()
+    else:
+        pygame.display.update(updatedRects)
     fpsClock.tick(maxFps) # recommended: 30 fps
 
-    it += 1
+    frame += 1
 
-fps = it / ( datetime.datetime.now().timestamp()-timeStampStart )
-print ("[Quit] (", fps,"frames per second )")
+fps = frame / ( datetime.datetime.now().timestamp()-timeStampStart )
+print ("[Quit] (", fps,"frames per second,", it,"ticks )")
 
+defaultWorld.stopJournal()
 pygame.quit()
 sys.exit()